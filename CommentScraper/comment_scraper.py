@@ -8,24 +8,67 @@ import os
 import subprocess
 import json
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from time import sleep
 import psutil
-import steam.webauth as wa
-from bs4 import BeautifulSoup
 import requests
+from requests.adapters import HTTPAdapter
+import steam.webauth as wa
+sys.path.append(str(Path(__file__).resolve().parent.parent / "ScraperCommon"))
+from http_cache import CachedFetcher
+import html_parsing
+from discord_delivery import DiscordOutbox
+from metrics import create_metrics
+from steam_api import SteamApi
+import replay
+from comment_threads import CommentThreads
+from comment_watermarks import CommentWatermarks, isSeen
+from reply_inbox import ReplyInbox
 
 CONFIG_PATH = "./comment_scraper.json"
 if not os.path.isfile(CONFIG_PATH):
     print(f"No config-file found: {CONFIG_PATH}, create and try again")
     sys.exit()
 
+# --once stops after the first cycle instead of polling every minute
+RUNONCE = "--once" in sys.argv[1:]
+# The old replies-file is still read and moved into the inbox
 REPLIES = "./replies.json"
+REPLYINBOX = "./replies.jsonl"
+COUNTSURL = "https://steamcommunity.com/actions/GetNotificationCounts"
+# Key of the comment notifications in the counts
+COMMENTNOTIFICATIONS = "4"
 COMMENTS = "./comments/"
-
-
-if not os.path.isfile(REPLIES):
-    Path(REPLIES).touch()
+ITEMLINK = re.compile(r"https://steamcommunity\.com/sharedfiles/filedetails/\?id=(\d+)$")
+# Screenshots are published files of the steam screenshots app
+SCREENSHOTS_APPID = 760
+# Steam emoticon name to emoji, extended or changed with the emoticon_map setting
+EMOTICONS = {
+    'steamthumbsup': ':thumbsup:',
+    'steamthumbsdown': ':thumbsdown:',
+    'bigups': ':thumbsup:',
+    'steamhappy': ':smiley:',
+    'steamfacepalm': ':person_facepalming:',
+    'reheart': ':heartpulse:',
+    'luv': ':heart:',
+    'LIS_pixel_heart': ':heart:',
+    'love': ':heart:',
+    'steamhearteyes': ':heart_eyes:',
+    'blocked': ':shield:',
+    'nekoheart': ':heart:',
+    'yay': ':smiley:',
+    'vanilla2': ':eye:',
+    'awywink': ':wink:',
+    'auimp': ':space_invader:',
+    'mhwno': ':no_entry:',
+    'csgoanarchist': ':cowboy:',
+    'steamsad': ':pensive:',
+}
+# Stop at the end of their own tag, so several links or images on a line are kept apart
+LINKFILTER = re.compile(r'<a\b[^>]*?\bhref="(?P<link>[^"]*)"[^>]*>(?P<text>[^<]*)</a>')
+IMAGEFILTER = re.compile(r'<img\b[^>]*?\bsrc="(?P<link>[^"]*)"[^>]*>')
+EXTERNALLINKFILTER = re.compile(r'<span class="bb_link_host">.*?</span>')
 
 
 def read_json(file_path):
@@ -43,13 +86,6 @@ def remove_json(file_path, mod_id):
         file.close()
 
 
-def clear_json(file_path):
-    """Clears json file"""
-    with open(file_path, 'w', encoding="utf8") as file:
-        file.write("{}")
-        file.close()
-
-
 mypid = psutil.Process().pid
 mycmdline = psutil.Process().cmdline()
 for proc in psutil.process_iter(['pid', 'cmdline']):
@@ -65,22 +101,38 @@ logWebhookUrl = settings["discord_log_channel"]
 displayname = settings["steam_displayname"]
 username = settings["steam_username"]
 password = settings["steam_password"]
-timestampfile = settings["timestamp_filename"]
+# Only read once, to start the watermarks from
+timestampfile = settings.get("timestamp_filename", "comment_scraper.lastrun")
 timestampfilePath = f"./{timestampfile}"
-
-if not os.path.isfile(timestampfilePath):
-    with open(timestampfile, 'w', encoding="utf8") as f:
-        f.write('')
+sessionFile = settings.get("session_file", "./steam_session.json")
+httpCacheTtls = settings.get("http_cache_ttls", {"/sharedfiles/filedetails/": 0})
+httpCacheMegabytes = settings.get("http_cache_megabytes", 50)
+emoticons = dict(EMOTICONS, **settings.get("emoticon_map", {}))
+html_parsing.select_backend(settings.get("html_parser", "auto"))
+metrics = create_metrics("comment_scraper", settings)
+html_parsing.set_metrics(metrics)
+discordFlushSeconds = settings.get("discord_flush_seconds", 120)
+commentPageSize = settings.get("comment_page_size", 10)
+commentMaxPages = settings.get("comment_max_pages", 10)
+watermarkMaxAgeDays = settings.get("watermark_max_age_days", 180)
+commentWorkers = max(1, settings.get("comment_workers", 4))
+pollMinSeconds = settings.get("poll_min_seconds", 20)
+# Never slower than the old once a minute
+pollMaxSeconds = min(60, settings.get("poll_max_seconds", 60))
+pollBackoff = settings.get("poll_backoff", 1.5)
+outbox = DiscordOutbox("./outbox.db", metrics=metrics)
+replay.install(outbox.session)
+outbox.start()
+watermarks = CommentWatermarks("./comment_watermarks.db")
+watermarks.migrateTimestamp(timestampfilePath)
+commentPool = ThreadPoolExecutor(max_workers=commentWorkers)
+inbox = ReplyInbox(REPLYINBOX, REPLIES, settings.get("reply_max_attempts", 10),
+                   settings.get("reply_max_age_hours", 24))
 
 
 def sendDiscordPost(data, url):
-    result = requests.post(url, json=data)
-    try:
-        result.raise_for_status()
-    except requests.exceptions.HTTPError as err:
-        print(err)
-    else:
-        print(f"Payload delivered successfully, code {result.status_code}.")
+    """Queues the message, the outbox posts it in the background"""
+    outbox.enqueue(url, data)
 
 
 def sendlogpost(title, logtext):
@@ -129,6 +181,171 @@ def senddiscordpost(modurl, modtitle, authorname, authorpagelink, authorimage, m
     sendDiscordPost(data, webhookUrl)
 
 
+def commentstamp(comment):
+    """Returns the timestamp of a comment div, None if it has none"""
+    stamp = comment.find("span", {"class": "commentthread_comment_timestamp"})
+    return int(stamp['data-timestamp']) if stamp else None
+
+
+def notificationstamp(notification):
+    """Returns the timestamp of the newest comment a notification is about"""
+    return int(notification.find(
+        "div", {"class": "commentnotification_date"}).find("span")['data-timestamp'])
+
+
+def readnotification(notification, itemDetails, archiveMode, session_id):
+    """Fetches the new comments of the thread of a notification, runs in the worker pool.
+    Returns the thread, the comments to post as (timestamp, senddiscordpost arguments)
+    and the new watermark, None if the thread has nothing new"""
+    link = (notification.find("a")['href']).split('&')[0]
+    mainStamp = notificationstamp(notification)
+    threadKey = link
+    watermark = watermarks.get(threadKey)
+    if watermark and not archiveMode and watermark[1] >= mainStamp:
+        # Notification for comments that were already handled
+        metrics.count("threads_skipped")
+        return None
+    if watermark:
+        sinceId, sinceStamp = watermark
+    else:
+        # Threads not seen before start at the newest handled comment, but always include the notified one
+        sinceId = None
+        sinceStamp = min(watermarks.highest() or mainStamp, mainStamp - 1)
+
+    allComments = None
+    itemMatch = ITEMLINK.match(link)
+    if itemMatch and itemMatch.group(1) in itemDetails:
+        details = itemDetails[itemMatch.group(1)]
+        allComments = threads.newComments(
+            itemMatch.group(1), sinceStamp, session_id, sinceId)
+        if details.get('creator_app_id') == SCREENSHOTS_APPID:
+            modName = "Screenshot comment"
+        else:
+            modName = details.get('title', "")
+
+    if allComments is None:
+        linkPage = fetcher.get(link)
+        linkSoup = html_parsing.parse(
+            linkPage, html_parsing.COMMENT_PAGE)
+
+        if "discussion" in link:
+            modName = linkSoup.find(
+                "div", {"class": "topic"}).text.strip()
+        elif linkSoup.find("div", {"class": "screenshotApp"}):
+            modName = "Screenshot comment"
+        else:
+            modName = linkSoup.find(
+                "div", {"class": "workshopItemTitle"}).text.strip()
+        allComments = linkSoup.findAll(
+            "div", {"class": "commentthread_comment"})[::-1]
+        if len(allComments) == 0:
+            link = f"https://steamcommunity.com/sharedfiles/filedetails/comments/{link.split('=')[1]}"
+            linkPage = fetcher.get(link)
+            linkSoup = html_parsing.parse(
+                linkPage, html_parsing.COMMENT_PAGE)
+            allComments = linkSoup.findAll(
+                "div", {"class": "commentthread_comment"})
+
+    if archiveMode:
+        allComments = [allComments[-1]]
+
+    posts = []
+    for comment in allComments:
+        hiddenContent = comment.find(
+            "div", {"class": "comment_hidden_content"})
+        if hiddenContent:
+            continue
+        commentStamp = commentstamp(comment)
+        if not archiveMode and isSeen(comment.get('id'), commentStamp, sinceId, sinceStamp):
+            continue
+        author = comment.find(
+            "a", {"class": "commentthread_author_link"}).text.replace(" (", "|").split("|")[0].strip()
+        if author == "Mlie":
+            continue
+        authorPage = comment.find("a").attrs['href']
+        imageUrl = comment.find("img")['src']
+        textDiv = comment.find(
+            "div", {"class": "commentthread_comment_text"})
+        TEXT = ""
+        for textBit in textDiv.contents:
+            if str(textBit) == "<br/>":
+                TEXT = TEXT + "\n"
+            else:
+                TEXT = TEXT + str(textBit).strip()
+        if "needs_content_check" in TEXT:
+            continue
+        posts.append((commentStamp or 0, link, modName, author,
+                      authorPage, imageUrl, TEXT))
+
+    newestId, newestStamp = None, mainStamp
+    for comment in allComments:
+        commentStamp = commentstamp(comment)
+        if commentStamp is not None and commentStamp >= newestStamp:
+            newestId, newestStamp = comment.get('id'), commentStamp
+    return {'thread': threadKey, 'posts': posts, 'newest': (newestId, newestStamp)}
+
+
+def readthread(notification, itemDetails, archiveMode, session_id):
+    """readnotification for the worker pool. A thread whose pages fail is skipped, its
+    watermark stays so the comments are read with its next notification"""
+    try:
+        return readnotification(notification, itemDetails, archiveMode, session_id)
+    except requests.exceptions.RequestException as e:
+        print(f"Could not read the comments of {notification.find('a')['href']}: {e}")
+        return None
+
+
+def postreply(modid, comment, session_id, cookies):
+    """Posts a queued reply in the comment thread of the item, False if steam did not take it.
+    Only a reply without a comment thread is dropped, anything else stays queued until steam confirms it"""
+    try:
+        pageid = threads.ownerOf(modid)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Could not read the comment thread of {modid}: {e}, trying again next cycle")
+        return False
+    if not pageid:
+        print(f"{modid} has no comment thread, dropping the reply")
+        return True
+    commentUrl = f"https://steamcommunity.com/comment/PublishedFile_Public/post/{pageid}/{modid}"
+    data = {'comment': comment, 'sessionid': session_id, 'feature2': -1}
+    try:
+        with metrics.stage("replies"):
+            replyResponse = user.session.post(
+                commentUrl, data=data, cookies=cookies)
+    except requests.exceptions.RequestException as e:
+        print(f"Posting the reply to {modid} failed: {e}, trying again next cycle")
+        return False
+    metrics.request(commentUrl, replyResponse.status_code)
+    # A login redirect or an error page is a 200 as well, only the json success counts
+    try:
+        success = 200 <= replyResponse.status_code < 300 and replyResponse.json().get('success') is True
+    except (ValueError, AttributeError):
+        success = False
+    if not success:
+        print(f"Posting the reply to {modid} failed with {replyResponse.status_code}: "
+              f"{replyResponse.text[:200]!r}, trying again next cycle")
+        return False
+    return True
+
+
+def notificationcount():
+    """Returns the number of unread comment notifications from the small json endpoint, None if that failed"""
+    with metrics.stage("counts"):
+        response = user.session.get(COUNTSURL)
+    metrics.request(COUNTSURL, response.status_code, len(response.content))
+    try:
+        return int(response.json()['notifications'][COMMENTNOTIFICATIONS])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def nextpollinterval(interval, active):
+    """Polls at the shortest interval after activity and slows down while it stays quiet"""
+    if active:
+        return pollMinSeconds
+    return min(pollMaxSeconds, interval * pollBackoff)
+
+
 def steamemoticon(message):
     """Replaces steam emoticons to emojis"""
     message = message.replace(
@@ -137,133 +354,157 @@ def steamemoticon(message):
     message = message.replace(
         'https://community.cloudflare.steamstatic.com/economy/', ''
     )
-    message = message.replace(
-        'emoticon/steamthumbsup', ':thumbsup:')
-    message = message.replace(
-        'emoticon/steamthumbsdown', ':thumbsdown:')
-    message = message.replace(
-        'emoticon/bigups', ':thumbsup:')
-    message = message.replace(
-        'emoticon/steamhappy', ':smiley:')
-    message = message.replace(
-        'emoticon/steamfacepalm', ':person_facepalming:')
-    message = message.replace(
-        'emoticon/reheart', ':heartpulse:')
-    message = message.replace(
-        'emoticon/luv', ':heart:')
-    message = message.replace(
-        'emoticon/LIS_pixel_heart', ':heart:')
-    message = message.replace(
-        'emoticon/love', ':heart:')
-    message = message.replace(
-        'emoticon/steamhearteyes', ':heart_eyes:')
-    message = message.replace(
-        'emoticon/blocked', ':shield:')
-    message = message.replace(
-        'emoticon/nekoheart', ':heart:')
-    message = message.replace(
-        'emoticon/yay', ':smiley:')
-    message = message.replace(
-        'emoticon/vanilla2', ':eye:')
-    message = message.replace(
-        'emoticon/awywink', ':wink:')
-    message = message.replace(
-        'emoticon/auimp', ':space_invader:')
-    message = message.replace(
-        'emoticon/mhwno', ':no_entry:')
-    message = message.replace(
-        'emoticon/csgoanarchist', ':cowboy:')
-    message = message.replace(
-        'emoticon/steamsad', ':pensive:')
+    for name, emoji in emoticons.items():
+        message = message.replace(f'emoticon/{name}', emoji)
     return message
 
 
 def htmltodiscord(message):
     """Converts html-code to discord-friendly code"""
-    linkfilter = r'<a.*(?:href=")(?P<link>[^"]*)[^>]*>(?P<text>[^<]*)<\/a>'
-    imagefilter = r'<img.*src="(?P<link>.*)".*>'
-    externallinkfilter = r'<span class="bb_link_host">.*<\/span>'
-    message = message.replace('<br/><br/><br/>', '<br/><br/>')
-    message = message.replace('<br/>', '\n').replace('\\n', '\n')
-    message = message.replace('<i>', '*').replace('</i>', '*')
-    message = message.replace('<b>', '**').replace('</b>', '**')
-    message = message.replace('<u>', '__').replace('</u>', '__')
-    message = message.replace('<s>', '~~').replace('</s>', '~~')
-    message = message.replace('<li>', '* ').replace('</li>', '')
-    message = message.replace(
-        '⦿', '*').replace('•', '*').replace('https://steamcommunity.com/linkfilter/?url=', '')
-    message = message.replace('target="_blank"', '').replace(
-        'rel="noreferrer"', '').replace('class="bb_link"', '')
-    message = message.replace('<ul>', '').replace(
-        '<ul class="bb_ul">', '').replace('</ul>', '')
-    message = message.replace('</img>', '').replace('&amp;', '&')
-    message = message.replace('&lt;', '<').replace('&gt;', '>')
-    message = message.replace(
-        '<blockquote class="bb_blockquote with_author">', '>>> ')
-    message = message.replace('</blockquote>', '')
-    message = message.replace('</div>', '').replace('</di', '')
-    message = re.sub(linkfilter, r' \g<link> ', message)
-    message = re.sub(imagefilter, r' \g<link> ', message)
-    message = re.sub(externallinkfilter, '', message)
-    if len(message) > 4000:
-        message = message[0:4000]
-    return message
+    with metrics.stage("translate"):
+        message = message.replace('<br/><br/><br/>', '<br/><br/>')
+        message = message.replace('<br/>', '\n').replace('\\n', '\n')
+        message = message.replace('<i>', '*').replace('</i>', '*')
+        message = message.replace('<b>', '**').replace('</b>', '**')
+        message = message.replace('<u>', '__').replace('</u>', '__')
+        message = message.replace('<s>', '~~').replace('</s>', '~~')
+        message = message.replace('<li>', '* ').replace('</li>', '')
+        message = message.replace(
+            '⦿', '*').replace('•', '*').replace('https://steamcommunity.com/linkfilter/?url=', '')
+        message = message.replace('target="_blank"', '').replace(
+            'rel="noreferrer"', '').replace('class="bb_link"', '')
+        message = message.replace('<ul>', '').replace(
+            '<ul class="bb_ul">', '').replace('</ul>', '')
+        message = message.replace('</img>', '').replace('&amp;', '&')
+        message = message.replace('&lt;', '<').replace('&gt;', '>')
+        message = message.replace(
+            '<blockquote class="bb_blockquote with_author">', '>>> ')
+        message = message.replace('</blockquote>', '')
+        message = message.replace('</div>', '').replace('</di', '')
+        message = LINKFILTER.sub(r' \g<link> ', message)
+        message = IMAGEFILTER.sub(r' \g<link> ', message)
+        message = EXTERNALLINKFILTER.sub('', message)
+        if len(message) > 4000:
+            message = message[0:4000]
+        return message
+
+
+def exportmetrics():
+    """Writes the metrics of the finished cycle, if enabled"""
+    if not metrics.enabled:
+        return
+    fetcher.export_stats()
+    outbox.export_stats()
+    metrics.export()
 
 
-user = wa.WebAuth2()
+try:
+    user = wa.WebAuth2(username, retries=settings.get("login_retries", 3),
+                       backoff=settings.get("login_backoff", 0.5), timeout=settings.get("login_timeout", 10))
+except TypeError:
+    # steam/webauth.py still has an older copy of webauth_additions.py
+    print("steam/webauth.py is outdated, paste webauth_additions.py into it again to retry the login calls")
+    user = wa.WebAuth2(username)
+# Saved sessions need the current webauth_additions.py as well, without them every start logs in
+savedSessions = hasattr(user, 'resume')
+# The workers share the session, one pooled connection each
+user.session.mount("https://steamcommunity.com/", HTTPAdapter(pool_maxsize=commentWorkers))
+replay.install(user.session, commentWorkers)
+fetcher = CachedFetcher("./http_cache", httpCacheTtls,
+                        httpCacheMegabytes * 1024 * 1024, session=user.session, metrics=metrics)
+steamApi = SteamApi(session=user.session, metrics=metrics)
+
+
+def sessioncookies():
+    """Returns the sessionid and the cookies to post with, the login cookie changes when the token is refreshed"""
+    community = user.session.cookies._cookies["steamcommunity.com"]['/']
+    sessionid = community['sessionid'].value
+    return sessionid, {"sessionid": sessionid, "steamLoginSecure": community["steamLoginSecure"].value}
 
 
 loggedIn = False
 try:
-    # result = user.login(username, password)
-    twoFactor = subprocess.run(
-        ['steamguard', '--verbosity', 'error'], capture_output=True, text=True).stdout.strip()
-    result = user.login(username=username, password=password,
-                        twofactor_code=twoFactor)
+    # A saved session only needs a token refresh, the steamguard code is for a full login
+    if savedSessions and user.resume(sessionFile):
+        result = "resumed saved session"
+    else:
+        twoFactor = subprocess.run(
+            ['steamguard', '--verbosity', 'error'], capture_output=True, text=True).stdout.strip()
+        result = user.login(username=username, password=password,
+                            twofactor_code=twoFactor)
+        if savedSessions:
+            user.saveSession(sessionFile)
     loggedIn = user.session.verify
 except Exception as e:
     sendtestpost("Comment monitor", f"Fail: {e}")
+    outbox.flush(discordFlushSeconds)
     sys.exit()
 if not loggedIn:
+    outbox.flush(discordFlushSeconds)
     exit()
 
 try:
     sendlogpost("Comment monitor", f"Login successful: {result}")
+    threads = CommentThreads(user.session, fetcher, user.steamID,
+                             commentPageSize, commentMaxPages, metrics=metrics, path="./comment_owners.json")
 
-    session_id = user.session.cookies._cookies["steamcommunity.com"]['/']['sessionid'].value
-    login_secure = user.session.cookies._cookies["steamcommunity.com"]['/']["steamLoginSecure"].value
-    cookies = {"sessionid": session_id, "steamLoginSecure": login_secure}
-
+    pollInterval = min(max(60, pollMinSeconds), pollMaxSeconds)
+    # Unknown at the start, so the first cycle always reads the notifications page
+    lastCommentCount = None
     while user.session.verify:
-        currentNotifications = user.session.get(
-            f'https://steamcommunity.com/id/{displayname}/commentnotifications/').text
-        soup = BeautifulSoup(currentNotifications, 'html.parser')
+        # A rejected refresh token ends the loop, the restart does a full login
+        if savedSessions and not user.ensureFresh(sessionFile):
+            break
+        session_id, cookies = sessioncookies()
+
+        inbox.importLegacy()
+        repliesPosted = inbox.drain(
+            lambda modid, comment: postreply(modid, comment, session_id, cookies))
+        metrics.count("replies", repliesPosted)
+        threads.save()
+
+        # The page is only read when the unread count changed, reading it marks the notifications as read
+        commentCount = notificationcount()
+        if commentCount is not None and commentCount == lastCommentCount:
+            pollInterval = nextpollinterval(pollInterval, repliesPosted > 0)
+            metrics.gauge("poll_interval_seconds", pollInterval)
+            exportmetrics()
+            if RUNONCE:
+                break
+            with metrics.stage("sleep"):
+                sleep(pollInterval)
+            continue
 
-        LASTHIGHESTTIMESTAMP = 0
-        with open(timestampfile, "r", encoding="utf8") as f:
-            fileContent = f.read()
-            if fileContent:
-                LASTHIGHESTTIMESTAMP = int(fileContent)
-        NEWHIGHESTTIMESTAMP = LASTHIGHESTTIMESTAMP
+        notificationsUrl = f'https://steamcommunity.com/id/{displayname}/commentnotifications/'
+        with metrics.stage("notifications"):
+            notificationsResponse = user.session.get(notificationsUrl)
+        metrics.request(notificationsUrl, notificationsResponse.status_code,
+                        len(notificationsResponse.content))
+        # Steam redirects to the login page when it no longer accepts the access token
+        if "/login" in notificationsResponse.url:
+            print("Session no longer accepted, refreshing the access token")
+            if not savedSessions or not user.refreshAccessToken():
+                break
+            user.saveSession(sessionFile)
+            continue
+        # Reading the page should clear the count, compare with what steam reports afterwards
+        lastCommentCount = notificationcount()
+        currentNotifications = notificationsResponse.text
+        soup = html_parsing.parse(
+            currentNotifications, html_parsing.NOTIFICATIONS_PAGE)
 
         notificationsDiv = soup.find(
             "div", {"class": "commentnotifications_header_commentcount"})
 
-        replies = read_json(REPLIES)
-        clear_json(REPLIES)
-        for reply in replies:
-            modid = reply
-            comment = replies[reply]
-            answerPage = user.session.get(
-                f"https://steamcommunity.com/sharedfiles/filedetails/?id={modid}").text
-            pageid = answerPage.split(f"_{modid}_area")[0].split("_")[-1]
-            commentUrl = f"https://steamcommunity.com/comment/PublishedFile_Public/post/{pageid}/{modid}"
-            data = {'comment': comment, 'sessionid': session_id, 'feature2': -1}
-            user.session.post(commentUrl, data=data, cookies=cookies)
-
         if not notificationsDiv:
             print('No new notifications')
-            sleep(60)
+            pollInterval = nextpollinterval(pollInterval, repliesPosted > 0)
+            metrics.gauge("poll_interval_seconds", pollInterval)
+            exportmetrics()
+            if RUNONCE:
+                break
+            with metrics.stage("sleep"):
+                sleep(pollInterval)
             continue
 
         if notificationsDiv:
@@ -280,78 +521,61 @@ try:
                 "div", {"class": "commentnotification"})[:5]
 
         somethingsent = False
+        metrics.count("notifications", len(unreadNotifications))
+        # The titles of all workshop items in one api call, the comments then come from the render endpoint
+        # One notification per thread, the newest, so no thread is read twice at the same time
+        notificationsByThread = {}
         for notification in unreadNotifications:
-            link = (notification.find("a")['href']).split('&')[0]
-            linkPage = user.session.get(link).text
-            linkSoup = BeautifulSoup(linkPage, 'html.parser')
-
-            if "discussion" in link:
-                modName = linkSoup.find(
-                    "div", {"class": "topic"}).text.strip()
-            elif linkSoup.find("div", {"class": "screenshotApp"}):
-                modName = "Screenshot comment"
-            else:
-                modName = linkSoup.find(
-                    "div", {"class": "workshopItemTitle"}).text.strip()
-            allComments = linkSoup.findAll(
-                "div", {"class": "commentthread_comment"})[::-1]
-            if len(allComments) == 0:
-                link = f"https://steamcommunity.com/sharedfiles/filedetails/comments/{link.split('=')[1]}"
-                linkPage = user.session.get(link).text
-                linkSoup = BeautifulSoup(linkPage, 'html.parser')
-                allComments = linkSoup.findAll(
-                    "div", {"class": "commentthread_comment"})
-            mainStamp = int(notification.find(
-                "div", {"class": "commentnotification_date"}).find("span")['data-timestamp'])
-            NEWHIGHESTTIMESTAMP = mainStamp
-            if LASTHIGHESTTIMESTAMP == 0:
-                LASTHIGHESTTIMESTAMP = mainStamp - 1
-
-            ignored = []
-
-            if archiveMode:
-                allComments = [allComments[-1]]
-
-            for comment in allComments:
-                hiddenContent = comment.find(
-                    "div", {"class": "comment_hidden_content"})
-                if hiddenContent:
-                    continue
-                commentStamp = comment.find(
-                    "span", {"class": "commentthread_comment_timestamp"})['data-timestamp']
-                if not archiveMode and LASTHIGHESTTIMESTAMP >= int(commentStamp):
-                    ignored.append(commentStamp)
-                    continue
-                author = comment.find(
-                    "a", {"class": "commentthread_author_link"}).text.replace(" (", "|").split("|")[0].strip()
-                if author == "Mlie":
-                    continue
-                authorPage = comment.find("a").attrs['href']
-                imageUrl = comment.find("img")['src']
-                textDiv = comment.find(
-                    "div", {"class": "commentthread_comment_text"})
-                TEXT = ""
-                for textBit in textDiv.contents:
-                    if str(textBit) == "<br/>":
-                        TEXT = TEXT + "\n"
-                    else:
-                        TEXT = TEXT + str(textBit).strip()
-                if "needs_content_check" in TEXT:
-                    continue
-
-                senddiscordpost(link, modName, author,
-                                authorPage, imageUrl, TEXT)
-                sleep(5)
-
-        with open(timestampfile, 'w', encoding="utf8") as f:
-            f.write(str(NEWHIGHESTTIMESTAMP))
+            notificationsByThread[notification.find("a")['href'].split('&')[0]] = notification
+        itemDetails = {}
+        itemIds = []
+        for link, notification in notificationsByThread.items():
+            match = ITEMLINK.match(link)
+            watermark = watermarks.get(link)
+            if match and (not watermark or watermark[1] < notificationstamp(notification)):
+                itemIds.append(match.group(1))
+        if itemIds and not archiveMode:
+            try:
+                itemDetails = steamApi.published_file_details(itemIds)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Could not read the item details, using the item pages: {e}")
+        with metrics.stage("threads"):
+            results = [result for result in commentPool.map(
+                lambda notification: readthread(notification, itemDetails, archiveMode, session_id),
+                notificationsByThread.values()) if result]
+
+        # Pages are read concurrently, the comments still go out oldest first
+        for post in sorted((post for result in results for post in result['posts']), key=lambda post: post[0]):
+            senddiscordpost(*post[1:])
+            metrics.count("comments_posted")
+        if not archiveMode:
+            for result in results:
+                watermarks.advance(result['thread'], *result['newest'])
+
+        removedThreads = watermarks.compact(watermarkMaxAgeDays)
+        if removedThreads > 0:
+            print(f"Removed {removedThreads} inactive threads from the watermarks")
+        fetcher.save()
+        threads.save()
+        print(fetcher.summary())
         if somethingsent:
             sendlogpost("New comments", "Check them")
-        sleep(60)
-
-    sendlogpost("Comment monitor down", "No longer authorized")
+        pollInterval = nextpollinterval(pollInterval, True)
+        metrics.gauge("poll_interval_seconds", pollInterval)
+        exportmetrics()
+        if RUNONCE:
+            break
+        with metrics.stage("sleep"):
+            sleep(pollInterval)
+
+    if not RUNONCE:
+        sendlogpost("Comment monitor down", "No longer authorized")
 except Exception as e:
     sendlogpost("Comment monitor failed", str(e))
 
 
 sendtestpost("Comment monitor", "Restarting")
+outbox.flush(discordFlushSeconds)
+outbox.stop()
+commentPool.shutdown()
+watermarks.close()
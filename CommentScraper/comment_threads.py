@@ -0,0 +1,133 @@
+"""Newest comments of workshop items through steam's comment render endpoint
+
+The item pages are downloaded and parsed whole for a handful of comments.
+The render endpoint returns the comment html newest first in pages of
+pageSize, so only the pages down to the first already seen comment are
+requested. A comment thread belongs to the owner of the item, that is the
+logged in user for own mods. For other items the owner is read from the item
+page once. The owners are saved, the reply posts go to the same threads.
+"""
+import json
+import os
+import re
+
+import html_parsing
+from metrics import NULL_METRICS
+from comment_watermarks import isSeen
+
+RENDER_URL = "https://steamcommunity.com/comment/PublishedFile_Public/render/{owner}/{modid}/"
+ITEM_URL = "https://steamcommunity.com/sharedfiles/filedetails/?id={modid}"
+# Only on a real item page, not on the login or error pages steam answers with a 200 as well
+ITEM_PAGE_MARKERS = ('class="workshopItemTitle', 'class="screenshotApp')
+
+
+class CommentThreads(object):
+    session = None
+    fetcher = None
+    ownSteamId = None
+    pageSize = None
+    maxPages = None
+    owners = None
+    metrics = None
+    path = None
+    changed = False
+
+    def __init__(self, session, fetcher, ownSteamId, pageSize=10, maxPages=10, metrics=None, path=None):
+        self.session = session
+        self.fetcher = fetcher
+        self.ownSteamId = str(ownSteamId)
+        self.pageSize = pageSize
+        self.maxPages = maxPages
+        self.owners = {}
+        self.metrics = metrics or NULL_METRICS
+        self.path = path
+        if path and os.path.isfile(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.owners = json.load(f)
+            except ValueError as e:
+                print(f"Ignoring broken owner cache {path}: {e}")
+
+    def newComments(self, modid, sinceStamp, sessionid, sinceId=None):
+        """Returns the comment divs after the watermark (sinceId, sinceStamp), oldest first.
+        None when the thread could not be rendered, the caller then falls back to the item page"""
+        owner = self.owners.get(modid, self.ownSteamId)
+        comments = self._collect(owner, modid, sinceStamp, sinceId, sessionid)
+        if comments is None and modid not in self.owners:
+            try:
+                scraped = self._scrapeOwner(modid)
+            except ValueError:
+                scraped = None
+            if scraped and scraped != owner:
+                owner = scraped
+                comments = self._collect(owner, modid, sinceStamp, sinceId, sessionid)
+        if comments is not None and self.owners.get(modid) != owner:
+            self.owners[modid] = owner
+            self.changed = True
+        return comments
+
+    def ownerOf(self, modid):
+        """Returns the owner of the comment thread of an item, read from the item page only once.
+        None if the item page has no comment thread. Raises a RequestException when the page
+        could not be read and ValueError when steam answered with another page"""
+        owner = self.owners.get(modid)
+        if owner is None:
+            owner = self._scrapeOwner(modid)
+            if owner:
+                self.owners[modid] = owner
+                self.changed = True
+        return owner
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        self.changed = False
+        tempPath = f"{self.path}.tmp"
+        with open(tempPath, "w", encoding="utf-8") as f:
+            json.dump(dict(self.owners), f)
+        os.replace(tempPath, self.path)
+
+    def _collect(self, owner, modid, sinceStamp, sinceId, sessionid):
+        collected = []
+        start = 0
+        for _ in range(self.maxPages):
+            data = self._render(owner, modid, start, sessionid)
+            # The thread of a wrong owner renders as empty, yet there was a notification for it
+            if data is None or (start == 0 and not data.get('total_count')):
+                return None
+            page = html_parsing.parse(data.get('comments_html', ''), html_parsing.COMMENT_PAGE).findAll(
+                "div", {"class": "commentthread_comment"})
+            for comment in page:
+                stamp = comment.find("span", {"class": "commentthread_comment_timestamp"})
+                if stamp and isSeen(comment.get('id'), int(stamp['data-timestamp']), sinceId, sinceStamp):
+                    return collected[::-1]
+                collected.append(comment)
+            start += len(page)
+            if not page or start >= int(data['total_count']):
+                break
+        return collected[::-1]
+
+    def _render(self, owner, modid, start, sessionid):
+        url = RENDER_URL.format(owner=owner, modid=modid)
+        with self.metrics.stage("comments"):
+            response = self.session.post(url, data={'start': start, 'count': self.pageSize,
+                                                    'sessionid': sessionid, 'feature2': -1})
+        self.metrics.request(url, response.status_code, len(response.content))
+        if response.status_code != 200:
+            return None
+        try:
+            data = response.json()
+        except ValueError:
+            return None
+        if not data.get('success'):
+            return None
+        return data
+
+    def _scrapeOwner(self, modid):
+        page = self.fetcher.get(ITEM_URL.format(modid=modid)) or ""
+        match = re.search(rf"commentthread_PublishedFile_Public_(\d+)_{modid}_area", page)
+        if match:
+            return match.group(1)
+        if not any(marker in page for marker in ITEM_PAGE_MARKERS):
+            raise ValueError(f"no item page for {modid}")
+        return None
@@ -0,0 +1,109 @@
+"""Last seen comment per comment thread for the comment scraper
+
+Replaces the single high-water timestamp of timestamp_filename, which
+follows whichever notification was handled last, with one SQLite row per
+thread holding the id and timestamp of its newest handled comment. Rows are
+looked up when needed, so starting does not depend on the number of
+threads. Threads without new comments for a while are removed by compact().
+"""
+import os
+import sqlite3
+import threading
+import time
+
+
+def isSeen(commentId, stamp, sinceId, sinceStamp):
+    """True for comments up to the watermark. Comments in the same second as the watermark
+    only count as seen with an unknown watermark id, or if they are the watermark comment"""
+    if sinceId is not None:
+        return commentId == sinceId or stamp < sinceStamp
+    return stamp <= sinceStamp
+
+
+class CommentWatermarks(object):
+    connection = None
+    lock = None
+
+    def __init__(self, databasePath):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            str(databasePath), check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS watermarks (thread TEXT PRIMARY KEY, commentid TEXT, stamp INTEGER NOT NULL, seen REAL NOT NULL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS watermarks_seen ON watermarks (seen)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def get(self, thread):
+        """Returns (commentid, stamp) of the newest handled comment or None for an unknown thread"""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT commentid, stamp FROM watermarks WHERE thread = ?', (thread,)).fetchone()
+        return row
+
+    def advance(self, thread, commentid, stamp):
+        """Moves the watermark of the thread forward, an older comment leaves it where it is"""
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO watermarks (thread, commentid, stamp, seen) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (thread) DO UPDATE SET commentid = excluded.commentid, stamp = excluded.stamp, seen = excluded.seen '
+                'WHERE excluded.stamp >= watermarks.stamp', (thread, commentid, stamp, now))
+            self.connection.execute(
+                'UPDATE watermarks SET seen = ? WHERE thread = ?', (now, thread))
+            self._setMeta('highest', str(max(stamp, self._highest())))
+
+    def highest(self):
+        """Newest comment timestamp of all threads, the starting point for threads not seen before"""
+        with self.lock:
+            return self._highest()
+
+    def _highest(self):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'highest'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _setMeta(self, key, value):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def compact(self, maxAgeDays, intervalHours=24):
+        """Removes threads without new comments for maxAgeDays, at most once per intervalHours.
+        Returns the number removed"""
+        if not maxAgeDays or maxAgeDays <= 0:
+            return 0
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'compacted'").fetchone()
+            if row and now - float(row[0]) < intervalHours * 3600:
+                return 0
+            with self.connection:
+                removed = self.connection.execute(
+                    'DELETE FROM watermarks WHERE seen < ?', (now - maxAgeDays * 86400,)).rowcount
+                self._setMeta('compacted', str(now))
+            if removed > 0:
+                self.connection.execute('VACUUM')
+        return removed
+
+    def migrateTimestamp(self, timestampPath):
+        """One-time import of the old high-water timestamp as starting point for all threads"""
+        with self.lock:
+            done = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'timestamp_migrated'").fetchone()
+        if done:
+            return
+        stamp = 0
+        if os.path.isfile(timestampPath):
+            with open(timestampPath, "r", encoding="utf8") as f:
+                content = f.read().strip()
+            if content.isdigit():
+                stamp = int(content)
+        with self.lock, self.connection:
+            self._setMeta('highest', str(max(stamp, self._highest())))
+            self._setMeta('timestamp_migrated', str(time.time()))
+
+    def close(self):
+        self.connection.close()
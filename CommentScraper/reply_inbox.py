@@ -0,0 +1,176 @@
+"""Queued replies for the comment scraper
+
+Replies are appended as one json-line {"modid": ..., "comment": ...} to
+replies.jsonl. To post them the scraper first moves the file aside, so
+replies appended meanwhile start a new inbox instead of being cleared with
+the old one. append() locks the file and checks it is still the inbox before
+it writes, drain() takes the same lock once after the move, so a writer that
+opened the inbox just before it was moved either finished its line by then
+or writes it to the new inbox. The moved file is then read once and removed.
+Other programs adding replies should use append(), on windows a file can not
+be moved while it is open so plain appends are safe there.
+
+A reply that could not be posted is kept in a retry-file with its number of
+attempts and is tried again with the next drain, the replies after it are
+still posted. After maxAttempts failed attempts or maxAgeHours in the queue
+it is moved to replies.failed.jsonl.
+
+The old replies.json ({modid: comment}) is still read, it is moved aside and
+imported into the inbox the same way.
+"""
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where an open inbox can not be moved aside
+    fcntl = None
+
+
+class ReplyInbox(object):
+    path = None
+    drainingPath = None
+    retryPath = None
+    failedPath = None
+    legacyPath = None
+    maxAttempts = None
+    maxAgeHours = None
+
+    def __init__(self, path, legacyPath=None, maxAttempts=10, maxAgeHours=24):
+        self.path = path
+        self.drainingPath = f"{path}.draining"
+        self.retryPath = f"{path}.retry"
+        self.failedPath = f"{os.path.splitext(path)[0]}.failed.jsonl"
+        self.legacyPath = legacyPath
+        self.maxAttempts = maxAttempts
+        self.maxAgeHours = maxAgeHours
+
+    def append(self, modid, comment):
+        """Queues a reply, a single short write to a file opened for appending"""
+        line = json.dumps({'modid': str(modid), 'comment': comment, 'queued': time.time()}) + "\n"
+        while True:
+            with open(self.path, "a", encoding="utf8") as f:
+                _lock(f)
+                # Moved aside by drain after it was opened, the reply goes to the new inbox
+                if not _isCurrent(f, self.path):
+                    continue
+                f.write(line)
+                return
+
+    def importLegacy(self):
+        """Moves the replies of the old replies.json into the inbox, returns the number imported"""
+        if not self.legacyPath or not os.path.isfile(self.legacyPath):
+            return 0
+        importingPath = f"{self.legacyPath}.importing"
+        if not os.path.isfile(importingPath):
+            try:
+                os.replace(self.legacyPath, importingPath)
+            except OSError:
+                # Still opened by its writer on windows, tried again next cycle
+                return 0
+        with open(importingPath, "r", encoding="utf8") as f:
+            content = f.read().strip()
+        try:
+            replies = json.loads(content) if content else {}
+        except ValueError as e:
+            print(f"Ignoring broken {self.legacyPath}: {e}")
+            replies = {}
+        for modid, comment in replies.items():
+            self.append(modid, comment)
+        os.remove(importingPath)
+        return len(replies)
+
+    def drain(self, post):
+        """Calls post(modid, comment) for every queued reply, oldest first, returns the number posted.
+        A reply for which post returns False is kept for the next drain or given up, when post
+        raises that reply and the ones after it stay queued"""
+        if not os.path.isfile(self.drainingPath):
+            try:
+                os.replace(self.path, self.drainingPath)
+            except OSError:
+                # No new replies, or on windows a writer still has the inbox open
+                pass
+        # Replies kept by the last drain are older than the ones in the inbox
+        replies = self._read(self.retryPath)
+        if os.path.isfile(self.drainingPath):
+            replies += self._read(self.drainingPath)
+        if not replies and not os.path.isfile(self.drainingPath):
+            return 0
+        posted = 0
+        kept = []
+        for index, reply in enumerate(replies):
+            try:
+                done = post(reply['modid'], reply['comment'])
+            except Exception:
+                self._keep(kept + replies[index:])
+                raise
+            if done is not False:
+                posted += 1
+                continue
+            reply['attempts'] = reply.get('attempts', 0) + 1
+            if reply['attempts'] >= self.maxAttempts or time.time() - reply['queued'] > self.maxAgeHours * 3600:
+                self._fail(reply)
+            else:
+                kept.append(reply)
+        self._keep(kept)
+        return posted
+
+    def _read(self, path):
+        """Returns the replies of a queue file, a missing file has none"""
+        try:
+            with open(path, "rb") as f:
+                # Waits for writers that locked the inbox before it was moved, later ones find it moved
+                _lock(f)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        replies = []
+        for line in data.decode("utf8").splitlines():
+            if not line.strip():
+                continue
+            try:
+                reply = json.loads(line)
+                replies.append({'modid': reply['modid'], 'comment': reply['comment'],
+                                'queued': reply.get('queued') or time.time(),
+                                'attempts': reply.get('attempts', 0)})
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Dropping broken reply {line!r}: {e}")
+        return replies
+
+    def _keep(self, replies):
+        """Saves the replies that were not posted for the next drain, then removes the moved inbox"""
+        if replies:
+            tempPath = f"{self.retryPath}.tmp"
+            with open(tempPath, "wb") as f:
+                for reply in replies:
+                    f.write((json.dumps(reply) + "\n").encode("utf8"))
+            os.replace(tempPath, self.retryPath)
+        elif os.path.isfile(self.retryPath):
+            os.remove(self.retryPath)
+        if os.path.isfile(self.drainingPath):
+            os.remove(self.drainingPath)
+
+    def _fail(self, reply):
+        print(f"Giving up on the reply to {reply['modid']} after {reply['attempts']} attempts, "
+              f"moved to {self.failedPath}")
+        reply['failed'] = time.time()
+        with open(self.failedPath, "a", encoding="utf8") as f:
+            f.write(json.dumps(reply) + "\n")
+
+
+def _lock(f):
+    """Locks the file until it is closed"""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def _isCurrent(f, path):
+    """True while the opened file is still the one at path"""
+    if fcntl is None:
+        return True
+    try:
+        return os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+    except OSError:
+        return False
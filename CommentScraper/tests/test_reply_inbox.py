@@ -0,0 +1,88 @@
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from reply_inbox import ReplyInbox  # noqa: E402
+
+
+class ReplyInboxTest(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+        self.inbox = ReplyInbox(os.path.join(self.folder, "replies.jsonl"), maxAttempts=3)
+        self.posted = []
+
+    def post(self, modid, comment):
+        if modid == "locked":
+            return False
+        self.posted.append((modid, comment))
+        return True
+
+    def failed(self):
+        path = os.path.join(self.folder, "replies.failed.jsonl")
+        if not os.path.isfile(path):
+            return []
+        with open(path, "r", encoding="utf8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_posts_in_order(self):
+        self.inbox.append(1, "first")
+        self.inbox.append(2, "second")
+        self.assertEqual(self.inbox.drain(self.post), 2)
+        self.assertEqual(self.posted, [("1", "first"), ("2", "second")])
+        self.assertEqual(self.inbox.drain(self.post), 0)
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_failing_reply_does_not_block_the_others(self):
+        self.inbox.append("locked", "never accepted")
+        self.inbox.append(1, "first")
+        for cycle in range(5):
+            self.inbox.append(2, f"cycle {cycle}")
+            self.assertEqual(self.inbox.drain(self.post), 2 if cycle == 0 else 1)
+        self.assertEqual(self.posted, [("1", "first")] + [("2", f"cycle {cycle}") for cycle in range(5)])
+        failed = self.failed()
+        self.assertEqual([(reply['modid'], reply['attempts']) for reply in failed], [("locked", 3)])
+        self.assertFalse(os.path.isfile(self.inbox.retryPath))
+
+    def test_old_reply_is_given_up(self):
+        self.inbox.append("locked", "never accepted")
+        self.inbox.drain(self.post)
+        with open(self.inbox.retryPath, "r", encoding="utf8") as f:
+            reply = json.loads(f.read())
+        reply['queued'] = time.time() - 25 * 3600
+        with open(self.inbox.retryPath, "w", encoding="utf8") as f:
+            f.write(json.dumps(reply) + "\n")
+        self.inbox.drain(self.post)
+        self.assertEqual([reply['attempts'] for reply in self.failed()], [2])
+
+    def test_raising_post_keeps_the_rest(self):
+        self.inbox.append(1, "first")
+        self.inbox.append(2, "second")
+
+        def post(modid, comment):
+            if modid == "2":
+                raise RuntimeError("steam down")
+            self.posted.append((modid, comment))
+
+        with self.assertRaises(RuntimeError):
+            self.inbox.drain(post)
+        self.assertEqual(self.inbox.drain(self.post), 1)
+        self.assertEqual(self.posted, [("1", "first"), ("2", "second")])
+
+    def test_legacy_replies_are_imported(self):
+        legacyPath = os.path.join(self.folder, "replies.json")
+        with open(legacyPath, "w", encoding="utf8") as f:
+            json.dump({"1": "legacy"}, f)
+        inbox = ReplyInbox(self.inbox.path, legacyPath)
+        self.assertEqual(inbox.importLegacy(), 1)
+        self.assertEqual(inbox.drain(self.post), 1)
+        self.assertEqual(self.posted, [("1", "legacy")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,20 +1,45 @@
 # Add this to the webauth.py file
 
+# Needed in addition to the imports webauth.py already has
+import asyncio
+import os
+from base64 import urlsafe_b64decode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 API_HEADERS = {
     'origin': 'https://steamcommunity.com',
     'referer': 'https://steamcommunity.com/',
     'accept': 'application/json, text/plain, */*'
 }
+API_URL = 'https://api.steampowered.com/'
+API_RETRIES = 3
+API_BACKOFF = 0.5
+API_TIMEOUT = 10
+_apiSession = None
 
 
-def sendAPIRequest(data, sApiInterface, sApiMethod, sApiVersion):
-    sUrl = "https://api.steampowered.com/{}Service/{}/v{}".format(
-        sApiInterface, sApiMethod, sApiVersion)
+def mountApiAdapter(session, retries=API_RETRIES, backoff=API_BACKOFF):
+    """Keeps the api connections alive and retries connection errors and 429/5xx responses
+    with exponential backoff. Only mounted for the api host, posted comments are never repeated"""
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(['GET', 'POST']), raise_on_status=False)
+    session.mount(API_URL, HTTPAdapter(max_retries=retry))
+    return session
+
+
+def sendAPIRequest(data, sApiInterface, sApiMethod, sApiVersion, session=None, timeout=API_TIMEOUT):
+    global _apiSession
+    if session is None:
+        if _apiSession is None:
+            _apiSession = mountApiAdapter(requests.session())
+        session = _apiSession
+    sUrl = "{}{}Service/{}/v{}".format(
+        API_URL, sApiInterface, sApiMethod, sApiVersion)
     if sApiMethod == "GetPasswordRSAPublicKey":
-        res = requests.get(sUrl, timeout=10, headers=API_HEADERS, params=data)
+        res = session.get(sUrl, timeout=timeout, headers=API_HEADERS, params=data)
     else:
-        res = requests.post(sUrl, timeout=10, headers=API_HEADERS, data=data)
+        res = session.post(sUrl, timeout=timeout, headers=API_HEADERS, data=data)
     res.raise_for_status()
     return res.json()
 
@@ -33,20 +58,29 @@ class WebAuth2(object):
     refreshToken = None
     accessToken = None
     session_id = None
+    sessionID = None
     logged_on = False
     session = None
     userAgent = None
+    timeout = API_TIMEOUT
 
     # Pretend to be chrome on windows, made this act as most like a browser as possible to (hopefully) avoid breakage in the future from valve
-    def __init__(self, username='', password='', userAgent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36'):
+    def __init__(self, username='', password='', userAgent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36',
+                 retries=API_RETRIES, backoff=API_BACKOFF, timeout=API_TIMEOUT):
         self.session = requests.session()
         self.userAgent = userAgent
         self.username = username
         self.password = password
+        self.timeout = timeout
         self.session.headers['User-Agent'] = self.userAgent
+        # The api calls share the pooled connections (and a replay adapter) of the session
+        mountApiAdapter(self.session, retries, backoff)
+
+    def _apiRequest(self, data, sApiInterface, sApiMethod, sApiVersion):
+        return sendAPIRequest(data, sApiInterface, sApiMethod, sApiVersion, self.session, self.timeout)
 
     def _getRsaKey(self):
-        return sendAPIRequest({'account_name': self.username}, "IAuthentication", 'GetPasswordRSAPublicKey', 1)
+        return self._apiRequest({'account_name': self.username}, "IAuthentication", 'GetPasswordRSAPublicKey', 1)
 
     def _encryptPassword(self):
         r = self._getRsaKey()
@@ -61,7 +95,7 @@ class WebAuth2(object):
         return tuple((b64.decode('ascii'), r['response']['timestamp']))
 
     def _startSessionWithCredentials(self, sAccountEncryptedPassword, iTimeStamp):
-        r = sendAPIRequest(
+        r = self._apiRequest(
             {'device_friendly_name': self.userAgent,
                 'account_name': self.username,
                 'encrypted_password': sAccountEncryptedPassword,
@@ -80,7 +114,7 @@ class WebAuth2(object):
         self.requestID = r['response']['request_id']
         self.steamID = r['response']['steamid']
         self.steam_id = SteamID(self.steamID)
-        sendAPIRequest({'client_id': self.clientID,
+        self._apiRequest({'client_id': self.clientID,
                         'steamid': self.steamID,
                         'code_type': '3',
                         'code': self.twofactor_code
@@ -92,7 +126,7 @@ class WebAuth2(object):
             encryptedPassword[0], encryptedPassword[1])
 
     def _pollLoginStatus(self):
-        r = sendAPIRequest({
+        r = self._apiRequest({
             'client_id': str(self.clientID),
             'request_id': str(self.requestID)
         }, 'IAuthentication', 'PollAuthSessionStatus', 1)
@@ -100,7 +134,9 @@ class WebAuth2(object):
         self.accessToken = r['response']['access_token']
 
     def _finalizeLogin(self):
-        self.sessionID = generate_session_id()
+        # A resumed session keeps its sessionid, it is sent along with posted forms
+        if not self.sessionID:
+            self.sessionID = generate_session_id()
         self.logged_on = True
         for domain in ['store.steampowered.com', 'help.steampowered.com', 'steamcommunity.com']:
             self.session.cookies.set(
@@ -125,3 +161,99 @@ class WebAuth2(object):
         self._finalizeLogin()
 
         return self.session
+
+    def saveSession(self, path):
+        """Stores the tokens so the next start can skip the login. On posix the file is only readable
+        by the owner, on windows the mode is ignored and the file gets the permissions of its folder"""
+        data = {'username': self.username,
+                'steamID': self.steamID,
+                'refreshToken': self.refreshToken,
+                'accessToken': self.accessToken,
+                'sessionID': self.sessionID}
+        tempPath = f"{path}.tmp"
+        handle = os.open(tempPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(handle, 'w', encoding="utf-8") as file:
+            json.dump(data, file)
+        os.replace(tempPath, path)
+
+    def loadSession(self, path):
+        """Reads the tokens saved by saveSession, returns False if there is no usable session for the user"""
+        if not os.path.isfile(path):
+            return False
+        try:
+            with open(path, 'r', encoding="utf-8") as file:
+                data = json.load(file)
+        except ValueError:
+            return False
+        if self.username and data.get('username') != self.username:
+            return False
+        if not data.get('refreshToken') or not data.get('steamID'):
+            return False
+        self.steamID = data['steamID']
+        self.steam_id = SteamID(self.steamID)
+        self.refreshToken = data['refreshToken']
+        self.accessToken = data.get('accessToken')
+        self.sessionID = data.get('sessionID')
+        return True
+
+    def accessTokenExpiry(self):
+        """Returns the expiry of the access token (a JWT) as unix timestamp, None if unknown"""
+        try:
+            payload = self.accessToken.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return int(json.loads(urlsafe_b64decode(payload))['exp'])
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+            return None
+
+    def refreshAccessToken(self):
+        """Gets a new access token for the refresh token, returns False if steam rejected it"""
+        try:
+            # renewal_type 1 allows steam to also renew the refresh token
+            r = self._apiRequest({'refresh_token': self.refreshToken,
+                                'steamid': self.steamID,
+                                'renewal_type': 1
+                                }, 'IAuthentication', 'GenerateAccessTokenForApp', 1)
+        except requests.exceptions.HTTPError:
+            return False
+        accessToken = r.get('response', {}).get('access_token')
+        if not accessToken:
+            return False
+        self.accessToken = accessToken
+        # Steam only sends a new refresh token when the old one is about to expire
+        if r['response'].get('refresh_token'):
+            self.refreshToken = r['response']['refresh_token']
+        self._finalizeLogin()
+        return True
+
+    def ensureFresh(self, path=None, margin=300):
+        """Refreshes the access token when it expires within margin seconds and saves
+        the session to path if given. Returns False if the refresh token was rejected"""
+        expiry = self.accessTokenExpiry()
+        if expiry is not None and expiry - time() > margin:
+            return True
+        if not self.refreshAccessToken():
+            return False
+        if path:
+            self.saveSession(path)
+        return True
+
+    def resume(self, path, margin=300):
+        """Restores the session saved in path, one token-refresh at most.
+        Returns False when a full login is needed"""
+        if not self.loadSession(path):
+            return False
+        if not self.ensureFresh(path, margin):
+            return False
+        if not self.logged_on:
+            self._finalizeLogin()
+        return True
+
+    async def loginAsync(self, username='', password='', twofactor_code=''):
+        """Runs login in a worker thread so the caller can do other work while steam answers"""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.login, username, password, twofactor_code)
+
+    async def resumeAsync(self, path, margin=300):
+        """Runs resume in a worker thread, see loginAsync"""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.resume, path, margin)
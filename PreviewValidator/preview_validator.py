@@ -9,10 +9,14 @@ import os
 import json
 import pathlib
 import steam.webauth as wa
-from bs4 import BeautifulSoup
 from wand.image import Image
 import pyperclip
 import subprocess
+sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent / "ScraperCommon"))
+from http_cache import CachedFetcher
+import html_parsing
+from metrics import create_metrics
+import replay
 
 CONFIG_PATH = "./preview_validator.json"
 if not os.path.isfile(CONFIG_PATH):
@@ -26,26 +30,50 @@ def read_json(file_path):
         return json.load(file)
 
 
-modsfolder = pathlib.Path(r"E:\SteamLibrary\steamapps\common\RimWorld\Mods")
-previewExecutable = r"E:\ModPublishing\PowershellFunctions\SteamPreviewUploader\Compiled\SteamPreviewUploader.exe"
-allpublishedfiles = list(modsfolder.glob("*/About/PublishedFileId.txt"))
 settings = read_json(CONFIG_PATH)
+modsfolder = pathlib.Path(settings.get(
+    "mods_folder", r"E:\SteamLibrary\steamapps\common\RimWorld\Mods"))
+previewExecutable = settings.get(
+    "preview_uploader", r"E:\ModPublishing\PowershellFunctions\SteamPreviewUploader\Compiled\SteamPreviewUploader.exe")
+allpublishedfiles = list(modsfolder.glob("*/About/PublishedFileId.txt"))
 prefix = settings["modid_prefix"]
 username = settings["steam_username"]
 password = settings["steam_password"]
+sessionFile = settings.get("session_file", "./steam_session.json")
+# The validator changes the previews, so the page is always revalidated
+httpCacheTtls = settings.get("http_cache_ttls", {"/managepreviews/": 0})
+httpCacheMegabytes = settings.get("http_cache_megabytes", 50)
+html_parsing.select_backend(settings.get("html_parser", "auto"))
+metrics = create_metrics("preview_validator", settings)
+html_parsing.set_metrics(metrics)
 
-user = wa.WebAuth2(username)
-
-# If there is no two-factor code supplied as argument, prompt for it
-if len(sys.argv) < 2:
-    twoFactorCode = input(
-        "Logging in, paste two-factor code and press enter: ")
-else:
-    twoFactorCode = sys.argv[1]
+try:
+    user = wa.WebAuth2(username, retries=settings.get("login_retries", 3),
+                       backoff=settings.get("login_backoff", 0.5), timeout=settings.get("login_timeout", 10))
+except TypeError:
+    # steam/webauth.py still has an older copy of webauth_additions.py
+    print("steam/webauth.py is outdated, paste webauth_additions.py into it again to retry the login calls")
+    user = wa.WebAuth2(username)
+# Saved sessions need the current webauth_additions.py as well, without them every start logs in
+savedSessions = hasattr(user, 'resume')
+replay.install(user.session)
+fetcher = CachedFetcher("./http_cache", httpCacheTtls,
+                        httpCacheMegabytes * 1024 * 1024, session=user.session, metrics=metrics)
 
 tryagain = False
 try:
-    result = user.login(username, password, twoFactorCode)
+    if savedSessions and user.resume(sessionFile):
+        result = "resumed saved session"
+    else:
+        # If there is no two-factor code supplied as argument, prompt for it
+        if len(sys.argv) < 2:
+            twoFactorCode = input(
+                "Logging in, paste two-factor code and press enter: ")
+        else:
+            twoFactorCode = sys.argv[1]
+        result = user.login(username, password, twoFactorCode)
+        if savedSessions:
+            user.saveSession(sessionFile)
 except Exception as e:
     print("Comment monitor login failed", str(e))
     sys.exit()
@@ -57,6 +85,7 @@ try:
         modpath = os.path.split(os.path.split(publishfile)[0])[0]
         modname = os.path.basename(modpath)
         print(f"Checking {modname}")
+        metrics.count("mods_checked")
         sourcepath = os.path.join(os.path.split(
             os.path.split(publishfile)[0])[0], "source")
         aboutpath = os.path.join(os.path.split(publishfile)[0], "About.xml")
@@ -67,8 +96,8 @@ try:
         with open(publishfile, 'r') as f:
             id = f.read()
         uri = f'https://steamcommunity.com/sharedfiles/managepreviews/?id={id}'
-        previewpage = user.session.get(uri)
-        soup = BeautifulSoup(previewpage.text, 'html.parser')
+        previewpage = fetcher.get(uri)
+        soup = html_parsing.parse(previewpage, html_parsing.PREVIEW_PAGE)
         allscripts = soup.find_all('script', type="text/javascript")
         previewscript = list(
             filter(lambda a: 'gPreviewImages' in a.text, allscripts))[0].text
@@ -84,18 +113,26 @@ try:
             filepath = os.path.join(sourcepath, preview['filename'])
             tmppath = os.path.join(sourcepath, f"{preview['filename']}.bak")
             print(f"{modname} broken preview: {preview['filename']}")
-            if os.path.isfile(filepath):
-                with Image(filename=filepath) as img:
-                    img.save(filename=filepath)
-                pyperclip.copy(filepath.replace('\\\\', '\\'))
+            metrics.count("broken_previews")
+            with metrics.stage("repair"):
+                if os.path.isfile(filepath):
+                    with Image(filename=filepath) as img:
+                        img.save(filename=filepath)
+                    pyperclip.copy(filepath.replace('\\\\', '\\'))
 
-            index = preview["sortorder"] - 1
-            previewpath = filepath.replace('\\\\', '\\')
-            callstring = f'"{previewExecutable}" "{modpath}" "{previewpath}" "{index}"'
-            # print(callstring)
-            subprocess.call(callstring)
+                index = preview["sortorder"] - 1
+                previewpath = filepath.replace('\\\\', '\\')
+                callstring = f'"{previewExecutable}" "{modpath}" "{previewpath}" "{index}"'
+                # print(callstring)
+                subprocess.call(callstring)
             # webbrowser.open(uri, new=0, autoraise=True)
             # input('Continue?')
 
 except Exception as e:
     print("Session failed", str(e))
+
+fetcher.save()
+print(fetcher.summary())
+if metrics.enabled:
+    fetcher.export_stats()
+    metrics.export()
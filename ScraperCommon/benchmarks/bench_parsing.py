@@ -0,0 +1,67 @@
+"""Benchmarks html parsing per page type, backend and strainer
+
+Usage: python bench_parsing.py [--pages FOLDER] [--repeat N]
+
+Reports parse time and peak memory for the full tree and for the targeted
+SoupStrainer of every page type. Recorded pages can be given as
+FOLDER/<pagetype>.html, otherwise synthetic pages are used.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from bs4 import BeautifulSoup  # noqa: E402
+import html_parsing  # noqa: E402
+import synthetic_pages  # noqa: E402
+
+PAGE_TYPES = {
+    "search": (lambda: synthetic_pages.search_page(30), html_parsing.SEARCH_PAGE),
+    "changelog": (lambda: synthetic_pages.changelog_page("3000000000"), html_parsing.CHANGELOG_PAGE),
+    "filedetails": (lambda: synthetic_pages.mod_page("3000000000", 50), html_parsing.MOD_PAGE),
+    "comments": (lambda: synthetic_pages.mod_page("3000000000", 50), html_parsing.COMMENT_PAGE),
+    "notifications": (lambda: synthetic_pages.notifications_page(10), html_parsing.NOTIFICATIONS_PAGE),
+    "managepreviews": (lambda: synthetic_pages.managepreviews_page("3000000000"), html_parsing.PREVIEW_PAGE),
+}
+
+
+def measure(html, backend, strainer, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        BeautifulSoup(html, backend, parse_only=strainer)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    soup = BeautifulSoup(html, backend, parse_only=strainer)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del soup
+    return best, peak
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--pages", help="folder with recorded <pagetype>.html files")
+    argparser.add_argument("--repeat", type=int, default=10)
+    args = argparser.parse_args()
+    backends = html_parsing.available_backends()
+    print(f"{'page':<15} {'kB':>6} {'backend':<12} {'mode':<9} {'ms':>8} {'peak kB':>9}")
+    for page_type, (generator, strainer) in PAGE_TYPES.items():
+        recorded = os.path.join(args.pages or "", f"{page_type}.html")
+        if args.pages and os.path.isfile(recorded):
+            with open(recorded, "r", encoding="utf-8") as file:
+                html = file.read()
+        else:
+            html = generator()
+        size = len(html.encode("utf-8")) // 1024
+        for backend in backends:
+            for mode, only in (("full", None), ("strained", strainer)):
+                seconds, peak = measure(html, backend, only, args.repeat)
+                print(f"{page_type:<15} {size:>6} {backend:<12} {mode:<9} {seconds * 1000:>8.2f} {peak // 1024:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""End-to-end benchmark of the scripts against the replay server
+
+Usage: python bench_scripts.py [--scripts workshop,comments,previews] [--items 30,300,1000]
+                               [--runs 2] [--recordings FOLDER] [--keep]
+
+Every script runs as its own process with SCRAPER_REPLAY_URL pointing at a
+replay_server.py started here, in a temporary folder with a generated
+config. Reports the wall time, the requests the server answered, the
+discord messages and the peak memory of each run. Later runs of the same
+item count reuse the folder, so they show the warm caches and state.
+Needs a POSIX system for the per-process peak memory (os.wait4).
+"""
+import argparse
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import Request, urlopen
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.realpath(__file__))
+REPOSITORY = os.path.dirname(os.path.dirname(BENCHMARK_FOLDER))
+sys.path.append(BENCHMARK_FOLDER)
+sys.path.append(os.path.dirname(BENCHMARK_FOLDER))
+from replay_server import start_server  # noqa: E402
+from replay import REPLAY_ENV  # noqa: E402
+
+ITEMS_PER_PAGE = 30
+WEBHOOK = "https://discord.com/api/webhooks/0/replay"
+
+
+def workshop(folder, items):
+    config = {
+        "discord_new_mods_channel": WEBHOOK,
+        "discord_updated_mods_channel": WEBHOOK,
+        "discord_test_channel": WEBHOOK,
+        "steam_new_mods_search_url": "https://steamcommunity.com/workshop/browse/?appid=294100&browsesort=mostrecent",
+        "steam_updated_mods_search_url": "https://steamcommunity.com/workshop/browse/?appid=294100&browsesort=lastupdated&updated_date_range_filter_end=",
+        "caching_folder": os.path.join(folder, "cache"),
+        "digest_title": "Digest",
+        "discord_posts_per_hour": 1000000,
+        "steam_workshop_path": "",
+        "max_search_pages": items // ITEMS_PER_PAGE + 1,
+    }
+    config_path = os.path.join(folder, "workshop_scraper.json")
+    write_json(config_path, config)
+    return [os.path.join(REPOSITORY, "SteamWorkshopDiscordScript", "workshop_scraper.py"), f"--config={config_path}"]
+
+
+def comments(folder, items):
+    write_json(os.path.join(folder, "comment_scraper.json"), {
+        "discord_channel": WEBHOOK,
+        "discord_test_channel": WEBHOOK,
+        "discord_log_channel": WEBHOOK,
+        "steam_username": "replay",
+        "steam_password": "replay",
+        "steam_displayname": "replay",
+        "timestamp_filename": "comment_scraper.lastrun",
+    })
+    return [os.path.join(REPOSITORY, "CommentScraper", "comment_scraper.py"), "--once"]
+
+
+def previews(folder, items):
+    mods = os.path.join(folder, "Mods")
+    for index in range(items):
+        about = os.path.join(mods, f"Mod{index}", "About")
+        if os.path.isdir(about):
+            continue
+        os.makedirs(about)
+        with open(os.path.join(about, "About.xml"), "w", encoding="utf-8") as file:
+            file.write(f"<ModMetaData><packageId>Replay.Mod{index}</packageId></ModMetaData>")
+        with open(os.path.join(about, "PublishedFileId.txt"), "w", encoding="utf-8") as file:
+            file.write(str(3000000000 + index))
+    write_json(os.path.join(folder, "preview_validator.json"), {
+        "steam_username": "replay",
+        "steam_password": "replay",
+        "modid_prefix": "Replay",
+        "mods_folder": mods,
+        "preview_uploader": "true",
+    })
+    return [os.path.join(REPOSITORY, "PreviewValidator", "preview_validator.py"), "000000"]
+
+
+SCRIPTS = {"workshop": workshop, "comments": comments, "previews": previews}
+
+
+def write_json(path, data):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(data, file)
+
+
+def fake_steamguard(folder):
+    """The comment scraper asks the steamguard cli for the two-factor code"""
+    path = os.path.join(folder, "bin", "steamguard")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("#!/bin/sh\necho 000000\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return os.path.dirname(path)
+
+
+def replay_call(url, action):
+    request = Request(f"{url}/_replay/{action}", data=b"" if action == "reset" else None)
+    with urlopen(request, timeout=10) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def run(command, folder, url, log):
+    env = dict(os.environ)
+    env[REPLAY_ENV] = url
+    env["PATH"] = fake_steamguard(folder) + os.pathsep + env.get("PATH", "")
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable] + command, cwd=folder, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kB on linux and in bytes on macOS
+    peak = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return elapsed, os.waitstatus_to_exitcode(status), peak
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--scripts", default="workshop,comments,previews")
+    argparser.add_argument("--items", default="30,300,1000",
+                           help="comma-separated workshop item counts")
+    argparser.add_argument("--runs", type=int, default=2, help="runs per item count")
+    argparser.add_argument("--recordings", help="folder with recorded responses")
+    argparser.add_argument("--keep", action="store_true", help="keep the run folders")
+    args = argparser.parse_args()
+    print(f"{'script':<10} {'items':>6} {'run':>4} {'exit':>5} {'seconds':>8} {'requests':>9} "
+          f"{'discord':>8} {'embeds':>7} {'peak MB':>8}")
+    for name in args.scripts.split(','):
+        for items in (int(count) for count in args.items.split(',')):
+            server, url = start_server(items=items, recordings=args.recordings)
+            folder = tempfile.mkdtemp(prefix=f"bench_{name}_{items}_")
+            try:
+                for index in range(args.runs):
+                    command = SCRIPTS[name](folder, items)
+                    replay_call(url, "reset")
+                    with open(os.path.join(folder, f"run{index}.log"), "w", encoding="utf-8") as log:
+                        seconds, exitcode, peak = run(command, folder, url, log)
+                    stats = replay_call(url, "stats")
+                    print(f"{name:<10} {items:>6} {index + 1:>4} {exitcode:>5} {seconds:>8.2f} "
+                          f"{stats['total_requests']:>9} {stats['discord_messages']:>8} "
+                          f"{stats['discord_embeds']:>7} {peak / 1024 / 1024:>8.1f}")
+                    if exitcode != 0:
+                        print(f"  failed, see {os.path.join(folder, f'run{index}.log')}")
+                        args.keep = True
+            finally:
+                server.shutdown()
+                if not args.keep:
+                    shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
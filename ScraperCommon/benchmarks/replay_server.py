@@ -0,0 +1,372 @@
+"""Local stand-in for steam and discord
+
+Usage: python replay_server.py [--port 8765] [--items N] [--recordings FOLDER] [--record]
+
+Run a script with SCRAPER_REPLAY_URL=http://127.0.0.1:8765 and replay.py
+sends its requests here as /<host>/<path>. Responses come from the recorded
+pages in FOLDER when there is one for the request, otherwise from
+synthetic_pages.py scaled to N workshop items. With --record, requests that
+have no recording are forwarded to the real host and the response is saved,
+so a live run records the pages for later replays. Tokens in json responses
+and all Set-Cookie values are redacted before they are saved, replays answer
+with replay tokens instead. Only the headers needed for the page are
+forwarded and request headers are never saved. Writes like comment posts are
+never forwarded, they get the synthetic answer.
+
+Discord webhook posts are only counted and logged. The IAuthentication,
+finalizelogin and settoken endpoints of the steam login are answered with
+a successful login. GET /_replay/stats returns the request counters and
+POST /_replay/reset clears them.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlencode, urlsplit
+from urllib.request import Request, urlopen
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+import synthetic_pages  # noqa: E402
+
+STEAMID = "76561198000000000"
+# Query parameters that change every run and would never match a recording
+VOLATILE_PARAMS = ("updated_date_range_filter_end", "key", "sessionid", "access_token")
+# Json fields that hold login tokens, redacted in recordings
+SECRET_FIELDS = ("access_token", "refresh_token", "token", "webapi_token", "nonce", "auth")
+REDACTED = "redacted"
+# Request headers passed on with --record, cookies are needed for the logged in pages
+FORWARD_HEADERS = ("cookie", "user-agent", "accept", "accept-language", "content-type",
+                   "referer", "origin", "x-requested-with")
+# Endpoints that change the account, never forwarded with --record
+WRITE_KINDS = ("comment_post",)
+# Any odd 2048-bit number works as modulus, the password is never decrypted
+RSA_MODULUS = format((1 << 2047) | int(hashlib.sha256(b"replay").hexdigest(), 16) | 1, 'x')
+SESSION_COOKIES = ["sessionid=0123456789abcdef; Path=/",
+                   f"steamLoginSecure={STEAMID}%7C%7Creplay; Path=/"]
+
+
+def access_token():
+    """Unsigned JWT valid for a day, the scripts only read its exp claim"""
+    payload = base64.urlsafe_b64encode(json.dumps(
+        {'sub': STEAMID, 'exp': int(time.time()) + 86400}).encode("utf-8")).decode("ascii").rstrip('=')
+    return f"eyJhbGciOiJub25lIn0.{payload}.replay"
+
+
+def replace_secrets(value, replacement):
+    """Replaces the string values of SECRET_FIELDS in decoded json with replacement(field, value)"""
+    if isinstance(value, dict):
+        return {name: replacement(name, item) if name in SECRET_FIELDS and isinstance(item, str)
+                else replace_secrets(item, replacement) for name, item in value.items()}
+    if isinstance(value, list):
+        return [replace_secrets(item, replacement) for item in value]
+    return value
+
+
+def rewrite_json(body, replacement):
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return body
+    return json.dumps(replace_secrets(data, replacement)).encode("utf-8")
+
+
+def redact_cookie(cookie):
+    """Set-Cookie header with its value redacted, the steamid in front of a login cookie is kept"""
+    name, _, rest = cookie.partition('=')
+    value, separator, attributes = rest.partition(';')
+    steamid, marker, _ = value.partition('%7C%7C')
+    value = f"{steamid}{marker}{REDACTED}" if marker else REDACTED
+    return f"{name}={value}{separator}{attributes}"
+
+
+def replay_secret(name, value):
+    """Stands in for a redacted token when a recording is replayed"""
+    if value != REDACTED:
+        return value
+    return access_token() if name == "access_token" else "replay"
+
+
+def classify(host, path):
+    """Short name of the endpoint for the counters"""
+    if "discord" in host:
+        return "discord"
+    if host.startswith("api.") or host.startswith("login."):
+        return path.strip('/').split('/')[1] if path.count('/') > 1 else path.strip('/')
+    for kind, pattern in (("changelog", r"/filedetails/changelog/"), ("comments", r"/filedetails/comments/"),
+                          ("filedetails", r"/filedetails/"), ("browse", r"/workshop/browse"),
+                          ("commentnotifications", r"/commentnotifications"), ("managepreviews", r"/managepreviews/"),
+                          ("comment_render", r"^/comment/[^/]+/render/"), ("comment_post", r"^/comment/"),
+                          ("notificationcounts", r"/actions/GetNotificationCounts"), ("settoken", r"/settoken")):
+        if re.search(pattern, path):
+            return kind
+    return "other"
+
+
+class Recordings(object):
+    """Recorded responses keyed on method, url without volatile parameters and body"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.index = {}
+        self.index_path = os.path.join(folder, "index.json") if folder else None
+        if self.index_path and os.path.isfile(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                self.index = json.load(file)
+
+    @staticmethod
+    def key(method, url, body):
+        parts = urlsplit(url)
+        query = {name: values for name, values in parse_qs(parts.query).items()
+                 if name not in VOLATILE_PARAMS}
+        key = f"{method} {parts.netloc}{parts.path}?{urlencode(sorted(query.items()), doseq=True)}"
+        if body:
+            key += " " + hashlib.sha1(Recordings.stable_body(body)).hexdigest()
+        return key
+
+    @staticmethod
+    def stable_body(body):
+        """Form body without the volatile parameters, like the comment render posts with their sessionid"""
+        try:
+            form = parse_qs(body.decode("utf-8"), keep_blank_values=True, strict_parsing=True)
+        except (UnicodeDecodeError, ValueError):
+            return body
+        if not any(name in form for name in VOLATILE_PARAMS):
+            return body
+        return urlencode(sorted((name, values) for name, values in form.items()
+                                if name not in VOLATILE_PARAMS), doseq=True).encode("utf-8")
+
+    def get(self, key):
+        entry = self.index.get(key)
+        if not entry:
+            return None
+        with open(os.path.join(self.folder, entry['file']), "rb") as file:
+            return entry['status'], entry['headers'], file.read()
+
+    def put(self, key, status, headers, body):
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest() + ".body"
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, name), "wb") as file:
+            file.write(body)
+        with self.lock:
+            self.index[key] = {'file': name, 'status': status, 'headers': headers}
+            with open(self.index_path, "w", encoding="utf-8") as file:
+                json.dump(self.index, file, indent=1)
+
+
+class ReplayState(object):
+    def __init__(self, items=30, recordings=None, record=False, discord_log=None):
+        self.items = items
+        self.recordings = Recordings(recordings)
+        self.record = record and recordings is not None
+        self.discord_log = discord_log
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.discord_messages = 0
+            self.discord_embeds = 0
+            self.bytes_sent = 0
+
+    def count(self, kind, size):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self.bytes_sent += size
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'total_requests': sum(self.requests.values()),
+                    'discord_messages': self.discord_messages, 'discord_embeds': self.discord_embeds,
+                    'bytes_sent': self.bytes_sent}
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET", b"")
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.handle_request("POST", self.rfile.read(length))
+
+    def handle_request(self, method, body):
+        if self.path.startswith("/_replay/"):
+            if self.path == "/_replay/reset":
+                self.state.reset()
+            return self.respond(200, json.dumps(self.state.stats()), "application/json")
+        host, _, rest = self.path.lstrip('/').partition('/')
+        url = f"https://{host}/{rest}"
+        parts = urlsplit(url)
+        kind = classify(host, parts.path)
+        if kind == "discord":
+            return self.discord(body)
+        key = Recordings.key(method, url, body)
+        recorded = self.state.recordings.get(key)
+        if recorded is None and self.state.record and not self.is_write(method, kind):
+            recorded = self.redact(*self.forward(method, url, body))
+            self.state.recordings.put(key, *recorded)
+        if recorded is not None:
+            status, headers, data = recorded
+            if 'json' in headers.get('Content-Type', "") and REDACTED.encode("ascii") in data:
+                data = rewrite_json(data, replay_secret)
+            self.state.count(kind, len(data))
+            return self.respond(status, data, headers.get('Content-Type', "text/html"), headers.get('Set-Cookie', []))
+        response = self.synthetic(kind, parts, body)
+        if response is None:
+            self.state.count("unknown", 0)
+            return self.respond(404, f"No recording or synthetic page for {url}", "text/plain")
+        self.state.count(kind, len(response[0]))
+        return self.respond(200, *response)
+
+    def discord(self, body):
+        payload = json.loads(body or b"{}")
+        with self.state.lock:
+            self.state.discord_messages += 1
+            self.state.discord_embeds += len(payload.get('embeds', []))
+            self.state.requests['discord'] = self.state.requests.get('discord', 0) + 1
+            if self.state.discord_log:
+                with open(self.state.discord_log, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(payload) + "\n")
+        self.send_response(204)
+        self.send_header('X-RateLimit-Remaining', '5')
+        self.send_header('X-RateLimit-Reset-After', '0')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    @staticmethod
+    def is_write(method, kind):
+        """Comment posts and any unknown post, the recording run must not change the account"""
+        return kind in WRITE_KINDS or (method == "POST" and kind == "other")
+
+    @staticmethod
+    def redact(status, headers, body):
+        """Removes the login tokens and cookies from a response before it is saved"""
+        if 'json' in headers.get('Content-Type', ""):
+            body = rewrite_json(body, lambda name, value: REDACTED)
+        headers = dict(headers, **{'Set-Cookie': [redact_cookie(cookie) for cookie in headers.get('Set-Cookie', [])]})
+        return status, headers, body
+
+    def forward(self, method, url, body):
+        headers = {name: value for name, value in self.headers.items()
+                   if name.lower() in FORWARD_HEADERS}
+        try:
+            response = urlopen(Request(url, data=body if method == "POST" else None,
+                                       headers=headers, method=method), timeout=30)
+            status = response.status
+        except HTTPError as err:
+            response = err
+            status = err.code
+        recorded_headers = {'Content-Type': response.headers.get('Content-Type', "text/html"),
+                            'Set-Cookie': response.headers.get_all('Set-Cookie') or []}
+        return status, recorded_headers, response.read()
+
+    def synthetic(self, kind, parts, body):
+        query = parse_qs(parts.query)
+        form = parse_qs(body.decode("utf-8")) if body else {}
+        items = self.state.items
+        if kind == "browse":
+            start = (int(query.get('p', ['1'])[0]) - 1) * 30
+            return synthetic_pages.search_page(max(0, min(30, items - start)), start), "text/html"
+        if kind == "changelog":
+            return synthetic_pages.changelog_page(parts.path.rstrip('/').split('/')[-1], 3), "text/html"
+        if kind == "comments":
+            return synthetic_pages.mod_page(parts.path.rstrip('/').split('/')[-1], 10), "text/html"
+        if kind == "filedetails":
+            return synthetic_pages.mod_page(query.get('id', ['0'])[0], 10), "text/html"
+        if kind == "commentnotifications":
+            return synthetic_pages.notifications_page(items, items), "text/html"
+        if kind == "notificationcounts":
+            return json.dumps({'notifications': {'1': 0, '2': 0, '3': 0, '4': items, '5': 0, '6': 0}}), "application/json"
+        if kind == "managepreviews":
+            return synthetic_pages.managepreviews_page(query.get('id', ['0'])[0]), "text/html"
+        if kind == "comment_render":
+            return json.dumps(synthetic_pages.comment_render(
+                parts.path.rstrip('/').split('/')[-1], int(form.get('start', ['0'])[0]),
+                int(form.get('count', ['10'])[0]))), "application/json"
+        if kind == "comment_post":
+            return json.dumps({'success': True}), "application/json"
+        if kind == "GetPublishedFileDetails":
+            wids = [values[0] for name, values in form.items() if name.startswith('publishedfileids')]
+            return json.dumps({'response': {'result': 1, 'resultcount': len(wids), 'publishedfiledetails': [
+                synthetic_pages.file_details(wid) for wid in wids]}}), "application/json"
+        if kind == "GetPlayerSummaries":
+            steamids = query.get('steamids', [''])[0].split(',')
+            return json.dumps({'response': {'players': [
+                synthetic_pages.player_summary(steamid) for steamid in steamids if steamid]}}), "application/json"
+        if parts.path.startswith("/IAuthenticationService/"):
+            return self.authentication(parts.path), "application/json"
+        if kind == "finalizelogin":
+            return json.dumps({'steamID': STEAMID, 'transfer_info': [
+                {'url': "https://steamcommunity.com/login/settoken", 'params': {'nonce': "replay", 'auth': "replay"}}]}), "application/json"
+        if kind == "settoken" or (kind == "other" and parts.netloc == "steamcommunity.com"):
+            return json.dumps({'result': 1}), "application/json", SESSION_COOKIES
+        return None
+
+    def authentication(self, path):
+        method = path.strip('/').split('/')[1]
+        responses = {
+            'GetPasswordRSAPublicKey': {'publickey_mod': RSA_MODULUS, 'publickey_exp': "010001", 'timestamp': "1"},
+            'BeginAuthSessionViaCredentials': {'client_id': "1", 'request_id': "cmVwbGF5", 'interval': 0.1,
+                                               'allowed_confirmations': [{'confirmation_type': 3}], 'steamid': STEAMID},
+            'UpdateAuthSessionWithSteamGuardCode': {},
+            'PollAuthSessionStatus': {'refresh_token': "replay", 'access_token': access_token(), 'account_name': "replay"},
+            'GenerateAccessTokenForApp': {'access_token': access_token()},
+        }
+        return json.dumps({'response': responses.get(method, {})})
+
+    def respond(self, status, body, content_type, cookies=()):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for cookie in cookies:
+            self.send_header('Set-Cookie', cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(port=0, items=30, recordings=None, record=False, discord_log=None):
+    """Starts the server in a background thread, returns (server, base url)"""
+    handler = type("Handler", (ReplayHandler,), {
+        'state': ReplayState(items, recordings, record, discord_log)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--port", type=int, default=8765)
+    argparser.add_argument("--items", type=int, default=30,
+                           help="workshop items on the synthetic pages")
+    argparser.add_argument("--recordings", help="folder with recorded responses")
+    argparser.add_argument("--record", action="store_true",
+                           help="forward unrecorded requests to steam and record them")
+    argparser.add_argument("--discord-log", help="file the discord payloads are appended to")
+    args = argparser.parse_args()
+    server, url = start_server(args.port, args.items, args.recordings, args.record, args.discord_log)
+    print(f"Replaying on {url}, run the scripts with SCRAPER_REPLAY_URL={url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
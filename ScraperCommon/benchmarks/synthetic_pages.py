@@ -0,0 +1,123 @@
+"""Generates steam-like pages for the benchmarks
+
+The markup only contains what the scrapers read plus enough filler to have
+realistic page sizes. Recorded pages should be preferred when available.
+"""
+import json
+
+APPID = 294100
+FILLER = ''.join(
+    f'<div class="responsive_header_content"><a class="menuitem" href="https://store.steampowered.com/{i}">'
+    f'Menu item {i}</a><span class="tooltip">Tooltip text {i}</span></div>\n' for i in range(300))
+HEAD = ('<!DOCTYPE html><html><head><title>Steam Workshop</title>'
+        + ''.join(f'<link href="https://community.akamai.steamstatic.com/public/css/{i}.css" rel="stylesheet">' for i in range(20))
+        + '<script type="text/javascript">var g_sessionID = "0123456789abcdef";</script></head><body>')
+TAIL = '</body></html>'
+
+
+def workshop_id(index):
+    return str(3000000000 + index)
+
+
+def changenote(index):
+    return (f'Updated to version 1.{index}<br/><ul class="bb_ul"><li>Fixed <b>error</b> on load</li>'
+            f'<li>Added <a class="bb_link" href="https://steamcommunity.com/linkfilter/?url=https://github.com/example/{index}" '
+            f'target="_blank" rel="noreferrer">source</a></li></ul>')
+
+
+def search_page(count, start=0):
+    """Browse page with count items, like workshop/browse/?browsesort=..."""
+    items = []
+    scripts = []
+    for index in range(start, start + count):
+        wid = workshop_id(index)
+        items.append(
+            f'<div class="workshopItem"><a href="https://steamcommunity.com/sharedfiles/filedetails/?id={wid}&searchtext=" class="ugc" data-publishedfileid="{wid}">'
+            f'<div class="workshopItemPreviewHolder"><img class="workshopItemPreviewImage aspectratio_16x9" src="https://images.steamusercontent.com/ugc/{wid}/preview.png"></div></a>'
+            f'<a href="https://steamcommunity.com/sharedfiles/filedetails/?id={wid}&searchtext=" class="item_link"><div class="workshopItemTitle ellipsis">Example mod {index}</div></a>'
+            f'<div class="workshopItemAuthorName ellipsis">by&nbsp;<a class="workshop_author_link" href="https://steamcommunity.com/id/author{index % 7}/myworkshopfiles/?appid={APPID}">Author {index % 7}</a></div></div>')
+        data = {"id": wid, "title": f"Example mod {index}",
+                "description": f"Description of example mod {index}\r\nWith several lines of text " * 5,
+                "user_subscribed": False, "user_favorited": False, "played": False, "appid": APPID}
+        scripts.append(
+            f'<script>SharedFileBindMouseHover( "sharedfile_{wid}", false, {json.dumps(data)} );</script>')
+    return (HEAD + FILLER + '<div class="workshopBrowseItems">' + ''.join(items) + '</div>'
+            + ''.join(scripts) + FILLER + TAIL)
+
+
+def changelog_page(wid, updates=10):
+    """filedetails/changelog/<wid> with the latest update first"""
+    announcements = ''.join(
+        f'<div class="detailBox workshopAnnouncement noFooter changeLogCtn"><div class="headline">'
+        f'<div class="changelog headline">Update: {1 + index % 28} Oct, 2024 @ 3:{index % 60:02d}pm</div></div>'
+        f'<p id="{wid}{index}">{changenote(index)}</p></div>' for index in range(updates))
+    return HEAD + FILLER + announcements + FILLER + TAIL
+
+
+def mod_page(wid, comments=10):
+    """filedetails/?id=<wid> with description, author and comments"""
+    commentthread = ''.join(comment(index) for index in range(comments))
+    return (HEAD + FILLER
+            + f'<div class="workshopItemTitle">Example mod {wid}</div>'
+            + f'<div class="workshopItemDescription" id="highlightContent">{changenote(0) * 10}</div>'
+            + '<div class="friendBlock"><a class="friendBlockLinkOverlay" href="https://steamcommunity.com/id/author"></a>'
+            + '<div class="playerAvatar online"><img src="https://avatars.steamstatic.com/author_medium.jpg"></div></div>'
+            + f'<div class="commentthread_comments">{commentthread}</div>'
+            + f'<div id="commentthread_PublishedFile_Public_76561198000000000_{wid}_area"></div>'
+            + FILLER + TAIL)
+
+
+def comment(index, timestamp=None):
+    timestamp = timestamp or 1700000000 - index * 60
+    return (f'<div class="commentthread_comment responsive_body_text" id="comment_{index}">'
+            f'<div class="commentthread_comment_avatar playerAvatar"><a href="https://steamcommunity.com/id/user{index}"><img src="https://avatars.steamstatic.com/{index}.jpg"></a></div>'
+            f'<div class="commentthread_comment_content"><div class="commentthread_comment_author">'
+            f'<a class="hoverunderline commentthread_author_link" href="https://steamcommunity.com/id/user{index}"><bdi>User {index}</bdi></a>'
+            f'<span class="commentthread_comment_timestamp" data-timestamp="{timestamp}">1 hour ago</span></div>'
+            f'<div class="commentthread_comment_text" id="comment_content_{index}">Comment number {index}<br/>Does this work with the latest version?</div></div></div>')
+
+
+def comment_render(wid, start, count, total=30):
+    """JSON of comment/PublishedFile_Public/render/<owner>/<wid>/, newest comment first"""
+    comments = ''.join(comment(index) for index in range(start, min(start + count, total)))
+    return {"success": True, "name": f"PublishedFile_Public_76561198000000000_{wid}", "start": start,
+            "pagesize": count, "total_count": total, "comments_html": comments,
+            "timelastpost": 1700000000}
+
+
+def notifications_page(unread, total=50):
+    """id/<name>/commentnotifications/"""
+    notifications = ''.join(
+        f'<div class="commentnotification{" unread" if index < unread else ""}"><a href="https://steamcommunity.com/sharedfiles/filedetails/?id={workshop_id(index)}&tscn=1">'
+        f'Example mod {index}</a><div class="commentnotification_date"><span data-timestamp="{1700000000 - index * 60}">1 hour ago</span></div></div>'
+        for index in range(total))
+    header = f'<div class="commentnotifications_header_commentcount">{unread}</div>' if unread else ''
+    return HEAD + FILLER + header + notifications + FILLER + TAIL
+
+
+def managepreviews_page(wid, previews=8, broken=0):
+    """sharedfiles/managepreviews/?id=<wid>, the first broken previews have size 0"""
+    images = [{"previewid": str(index), "filename": f"preview{index}.png", "size": 0 if index < broken else 1000 * (index + 1),
+               "sortorder": index + 1} for index in range(previews)]
+    scripts = ''.join(
+        f'<script type="text/javascript">var gSomething{index} = {index};</script>' for index in range(30))
+    return (HEAD + FILLER + scripts
+            + f'<script type="text/javascript">var gPreviewImages = {json.dumps(images)};</script>'
+            + FILLER + TAIL)
+
+
+def file_details(wid):
+    """GetPublishedFileDetails entry of a workshop item"""
+    index = int(wid) - 3000000000
+    return {"publishedfileid": wid, "result": 1, "creator": f"7656119800000000{index % 7}",
+            "creator_app_id": APPID, "consumer_app_id": APPID, "title": f"Example mod {index}",
+            "description": f"[h1]Example mod {index}[/h1]\n[b]Description[/b] with a [url=https://github.com/example/{index}]link[/url]",
+            "preview_url": f"https://images.steamusercontent.com/ugc/{wid}/preview.png",
+            "time_created": 1600000000, "time_updated": 1700000000 + index}
+
+
+def player_summary(steamid):
+    """GetPlayerSummaries entry of an author"""
+    return {"steamid": steamid, "personaname": f"Author {steamid[-1]}",
+            "profileurl": f"https://steamcommunity.com/id/author{steamid[-1]}/",
+            "avatarmedium": f"https://avatars.steamstatic.com/{steamid}_medium.jpg"}
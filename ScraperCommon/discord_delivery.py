@@ -0,0 +1,263 @@
+"""Durable delivery of discord webhook messages
+
+Producers add payloads to an SQLite outbox and return at once, a background
+thread posts them in order per webhook, so a failing webhook does not hold
+back the others. Before a message is posted its row is claimed for a lease
+with a conditional update, so overlapping runs sharing the outbox never post
+the same message twice. Sending is paced by the X-RateLimit-* headers
+discord returns for each webhook, 429s wait for retry_after and transient
+failures are retried with exponential backoff. A message is only removed
+from the outbox once discord accepted it, so nothing is lost on a crash,
+unsent messages are posted on the next start.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+import requests
+
+from metrics import NULL_METRICS
+
+
+class RateLimitBucket(object):
+    """Token-bucket state for one webhook, filled from the response headers"""
+
+    def __init__(self):
+        self.remaining = None
+        self.reset_at = 0.0
+
+    def wait_time(self):
+        if self.remaining is None or self.remaining > 0:
+            return 0.0
+        return max(0.0, self.reset_at - time.time())
+
+    def update(self, headers):
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+        if remaining is not None:
+            self.remaining = int(remaining)
+        if reset_after is not None:
+            self.reset_at = time.time() + float(reset_after)
+
+    def block(self, seconds):
+        self.remaining = 0
+        self.reset_at = time.time() + seconds
+
+
+class DiscordOutbox(object):
+    """Persistent outbox with a background sender
+
+    enqueue() never touches the network, call start() once and flush() before
+    a one-shot script exits to give the sender time to drain the outbox.
+    """
+
+    def __init__(self, database_path, session=None, max_attempts=10,
+                 backoff_seconds=2.0, max_backoff_seconds=600.0, timeout=30, metrics=None):
+        self.session = session or requests.Session()
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.timeout = timeout
+        self.metrics = metrics or NULL_METRICS
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.buckets = {}
+        self.global_bucket = RateLimitBucket()
+        self.thread = None
+        self.stats = {'sent': 0, 'rate_limited': 0, 'retried': 0, 'failed': 0}
+        self.connection = sqlite3.connect(
+            str(database_path), check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL, '
+                'payload TEXT NOT NULL, key TEXT UNIQUE, attempts INTEGER NOT NULL DEFAULT 0, '
+                'next_attempt REAL NOT NULL DEFAULT 0, created REAL NOT NULL)')
+            columns = [row[1] for row in self.connection.execute(
+                'PRAGMA table_info(outbox)')]
+            if 'claimed' not in columns:
+                # Lease expiry of the run posting the message, older outboxes lack it
+                self.connection.execute(
+                    'ALTER TABLE outbox ADD COLUMN claimed REAL NOT NULL DEFAULT 0')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS failed (id INTEGER PRIMARY KEY, url TEXT NOT NULL, payload TEXT NOT NULL, '
+                'key TEXT, status INTEGER, error TEXT, failed REAL NOT NULL)')
+            # Keys of delivered messages, so a producer that crashed before it
+            # recorded the hand-off can not queue the same message again
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS sent (key TEXT PRIMARY KEY, sent REAL NOT NULL)')
+            self.connection.execute(
+                'DELETE FROM sent WHERE sent < ?', (time.time() - 7 * 86400,))
+
+    def enqueue(self, url, payload, key=None):
+        """Queues a webhook payload, returns False if a message with the same key is already queued or sent"""
+        with self.lock, self.connection:
+            if key is not None and self.connection.execute(
+                    'SELECT 1 FROM sent WHERE key = ?', (key,)).fetchone():
+                return False
+            inserted = self.connection.execute(
+                'INSERT OR IGNORE INTO outbox (url, payload, key, created) VALUES (?, ?, ?, ?)',
+                (url, json.dumps(payload), key, time.time())).rowcount
+        self.wakeup.set()
+        return inserted > 0
+
+    def pending(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def export_stats(self):
+        """Adds the queue depth and the delivery counters since start as gauges to the metrics"""
+        self.metrics.gauge("discord_queue_depth", self.pending())
+        for name, value in dict(self.stats).items():
+            self.metrics.gauge("discord_messages", value, result=name)
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(
+            target=self._run, name="discord-outbox", daemon=True)
+        self.thread.start()
+
+    def flush(self, timeout=None):
+        """Waits until the outbox is empty, returns False if the timeout passed first"""
+        self.start()
+        deadline = None if timeout is None else time.time() + timeout
+        while self.pending() > 0:
+            if deadline is not None and time.time() >= deadline:
+                print(f"{self.pending()} discord messages still queued, will be sent on the next run")
+                return False
+            self.wakeup.set()
+            time.sleep(0.2)
+        return True
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout=self.timeout + 5)
+        self.connection.close()
+
+    def _next(self):
+        """Claims the oldest message of a webhook that may be posted now.
+        Returns (row, None) or (None, seconds to wait), (None, None) for an empty outbox"""
+        now = time.time()
+        with self.lock:
+            # Only the oldest message per webhook, a message waiting for its
+            # retry holds back the ones after it for the same webhook only
+            heads = self.connection.execute(
+                'SELECT id, url, payload, key, attempts, next_attempt, claimed FROM outbox '
+                'WHERE id IN (SELECT MIN(id) FROM outbox GROUP BY url) ORDER BY id').fetchall()
+        if not heads:
+            return None, None
+        waits = []
+        for row_id, url, payload, key, attempts, next_attempt, claimed in heads:
+            bucket = self.buckets.setdefault(url, RateLimitBucket())
+            # A head claimed by another run is being posted there
+            wait = max(next_attempt - now, claimed - now, bucket.wait_time())
+            if wait > 0:
+                waits.append(wait)
+                continue
+            with self.lock, self.connection:
+                claimedRow = self.connection.execute(
+                    'UPDATE outbox SET claimed = ? WHERE id = ? AND claimed <= ?',
+                    (now + self.timeout + 30, row_id, now)).rowcount
+            if claimedRow:
+                return (row_id, url, payload, key, attempts), None
+            waits.append(1.0)
+        return None, min(waits)
+
+    def _release(self, row_id):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE outbox SET claimed = 0 WHERE id = ?', (row_id,))
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                wait = self.global_bucket.wait_time()
+                if wait > 0:
+                    self.stopping.wait(min(wait, 5))
+                    continue
+                row, wait = self._next()
+                if row is None:
+                    if wait is None:
+                        self.wakeup.wait(5)
+                        self.wakeup.clear()
+                    else:
+                        self.stopping.wait(min(wait, 5))
+                    continue
+                self._send(*row)
+            except Exception as err:
+                # Keeps the sender alive, the message is retried once its lease expired
+                print(f"Discord sender error: {err!r}")
+                self.stopping.wait(5)
+
+    def _send(self, row_id, url, payload, key, attempts):
+        bucket = self.buckets.setdefault(url, RateLimitBucket())
+        status = None
+        try:
+            with self.metrics.stage("discord"):
+                response = self.session.post(
+                    url, data=payload, headers={'Content-Type': 'application/json'}, timeout=self.timeout)
+            status = response.status_code
+            bucket.update(response.headers)
+        except Exception as err:
+            # Not only RequestException, anything raised here would end the sender thread
+            self.metrics.request(url, "error")
+            self._retry(row_id, url, payload, key, attempts, None, str(err) or repr(err))
+            return
+        self.metrics.request(url, status)
+        if status == 429:
+            retry_after = self._retry_after(response)
+            if response.headers.get('X-RateLimit-Global'):
+                self.global_bucket.block(retry_after)
+            else:
+                bucket.block(retry_after)
+            self._release(row_id)
+            self.stats['rate_limited'] += 1
+            return
+        if 200 <= status < 300:
+            with self.lock, self.connection:
+                self.connection.execute(
+                    'DELETE FROM outbox WHERE id = ?', (row_id,))
+                if key is not None:
+                    self.connection.execute(
+                        'INSERT OR IGNORE INTO sent (key, sent) VALUES (?, ?)', (key, time.time()))
+            self.stats['sent'] += 1
+            return
+        if status >= 500:
+            self._retry(row_id, url, payload, key,
+                        attempts, status, response.text)
+            return
+        # Other 4xx will never succeed, keep them for inspection
+        self._fail(row_id, url, payload, key, status, response.text)
+
+    def _retry_after(self, response):
+        try:
+            return float(response.json().get('retry_after', 1))
+        except (ValueError, TypeError, AttributeError):
+            return float(response.headers.get('Retry-After', 1))
+
+    def _retry(self, row_id, url, payload, key, attempts, status, error):
+        attempts += 1
+        if attempts >= self.max_attempts:
+            self._fail(row_id, url, payload, key, status, error)
+            return
+        delay = min(self.backoff_seconds * 2 ** attempts,
+                    self.max_backoff_seconds)
+        print(f"Discord post failed ({status or error}), retrying in {delay:.0f}s")
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE outbox SET attempts = ?, next_attempt = ?, claimed = 0 WHERE id = ?',
+                                    (attempts, time.time() + delay, row_id))
+        self.stats['retried'] += 1
+
+    def _fail(self, row_id, url, payload, key, status, error):
+        print(f"Discord post failed permanently ({status}): {error}")
+        with self.lock, self.connection:
+            self.connection.execute('INSERT INTO failed (id, url, payload, key, status, error, failed) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (row_id, url, payload, key, status, error, time.time()))
+            self.connection.execute(
+                'DELETE FROM outbox WHERE id = ?', (row_id,))
+        self.stats['failed'] += 1
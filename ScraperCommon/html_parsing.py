@@ -0,0 +1,78 @@
+"""Pluggable html parsing for the scrapers
+
+Picks the fastest installed BeautifulSoup tree-builder (lxml, falling back
+to the pure-python html.parser) and only builds the parts of a page that
+the scripts read, using the SoupStrainers below.
+"""
+import re
+from bs4 import BeautifulSoup, SoupStrainer
+
+from metrics import NULL_METRICS
+
+BACKENDS = ("lxml", "html.parser")
+
+
+def _classes(*names):
+    """Matches tags having any of the classes, strainers see the raw class-string
+    while parsing so a plain class-name would miss tags with several classes"""
+    return re.compile(r'(?:^|\s)(?:' + '|'.join(names) + r')(?:\s|$)')
+
+
+# Targeted extraction per page type, everything outside these nodes is skipped
+SEARCH_PAGE = SoupStrainer("div", class_=_classes("workshopItem"))
+CHANGELOG_PAGE = SoupStrainer("div", class_=_classes("workshopAnnouncement"))
+MOD_PAGE = SoupStrainer(class_=_classes(
+    "playerAvatar", "friendBlockLinkOverlay", "workshopItemDescription"))
+COMMENT_PAGE = SoupStrainer(class_=_classes(
+    "commentthread_comment", "topic", "screenshotApp", "workshopItemTitle"))
+NOTIFICATIONS_PAGE = SoupStrainer("div", class_=_classes(
+    "commentnotifications_header_commentcount", "commentnotification"))
+PREVIEW_PAGE = SoupStrainer("script")
+
+# Steam puts lists inside the changenote <p>, lxml closes the <p> before a
+# <ul> like a browser would, so these pages always use the lenient parser
+KEEP_NESTING = (CHANGELOG_PAGE,)
+
+_backend = None
+_metrics = NULL_METRICS
+
+
+def available_backends():
+    """Returns the installed tree-builders, fastest first"""
+    backends = []
+    for backend in BACKENDS:
+        try:
+            BeautifulSoup("", backend)
+        except Exception:
+            continue
+        backends.append(backend)
+    return backends
+
+
+def select_backend(preferred="auto"):
+    """Sets the parser used by parse(), "auto" picks the fastest installed one"""
+    global _backend
+    backends = available_backends()
+    if preferred in backends:
+        _backend = preferred
+    else:
+        if preferred != "auto":
+            print(f"HTML parser {preferred} is not available, using {backends[0]}")
+        _backend = backends[0]
+    return _backend
+
+
+def set_metrics(metrics):
+    """Times every parse() as the "parse" stage"""
+    global _metrics
+    _metrics = metrics
+
+
+def parse(html, only=None):
+    """Parses the html, only keeping the nodes matching the strainer if given"""
+    if _backend is None:
+        select_backend()
+    backend = "html.parser" if any(
+        only is page for page in KEEP_NESTING) else _backend
+    with _metrics.stage("parse"):
+        return BeautifulSoup(html, backend, parse_only=only)
@@ -0,0 +1,205 @@
+"""Caching fetch layer for steam community pages
+
+Keeps responses on disk, revalidates them with ETag/Last-Modified and
+evicts the least recently used entries when the cache grows too large.
+Only urls matching one of the configured TTL-patterns are cached, pages with
+TTL 0 are revalidated on every request and only stored when they have an
+ETag or Last-Modified header. Error responses raise like urlopen does, they
+are never returned as page text nor cached.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from metrics import NULL_METRICS
+
+
+class CachedFetcher(object):
+    """Fetches pages through a requests-session if given, otherwise via urllib"""
+
+    def __init__(self, cache_folder, ttls=None, max_bytes=50 * 1024 * 1024, session=None, timeout=30, metrics=None):
+        self.cache_folder = str(cache_folder)
+        self.ttls = [(re.compile(pattern), seconds)
+                     for pattern, seconds in (ttls or {}).items()]
+        self.max_bytes = max_bytes
+        self.session = session
+        self.timeout = timeout
+        self.metrics = metrics or NULL_METRICS
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'uncached': 0,
+                      'bytes_downloaded': 0, 'bytes_saved': 0}
+        self.index_path = os.path.join(self.cache_folder, "index.json")
+        self.index = {}
+        self.changed = False
+        os.makedirs(self.cache_folder, exist_ok=True)
+        if os.path.isfile(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as file:
+                    self.index = json.load(file)
+            except ValueError:
+                self.index = {}
+
+    def get_ttl(self, url):
+        """Returns the TTL in seconds for the url, None if it should not be cached"""
+        for pattern, seconds in self.ttls:
+            if pattern.search(url):
+                return seconds
+        return None
+
+    def get(self, url):
+        """Returns the page text, from the cache when it is still fresh"""
+        ttl = self.get_ttl(url)
+        if ttl is None:
+            _, text, _ = self._request(url, {})
+            with self.lock:
+                self.stats['uncached'] += 1
+            return text
+
+        with self.lock:
+            entry = self.index.get(url)
+        if entry and time.time() - entry['fetched'] < ttl:
+            text = self._read_body(entry)
+            if text is not None:
+                with self.lock:
+                    self.stats['hits'] += 1
+                    self.stats['bytes_saved'] += entry['size']
+                    entry['accessed'] = time.time()
+                    self.changed = True
+                return text
+            entry = None
+
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        status, text, response_headers = self._request(url, headers)
+        if status == 304 and entry:
+            text = self._read_body(entry)
+            if text is not None:
+                with self.lock:
+                    self.stats['revalidated'] += 1
+                    self.stats['bytes_saved'] += entry['size']
+                    entry['fetched'] = entry['accessed'] = time.time()
+                    self.changed = True
+                return text
+            status, text, response_headers = self._request(url, {})
+        with self.lock:
+            self.stats['misses'] += 1
+        # With TTL 0 a page is only worth storing when it can be revalidated, it is never served unchecked
+        if status == 200 and (ttl > 0 or response_headers.get('ETag') or response_headers.get('Last-Modified')):
+            self._store(url, text, response_headers)
+        elif entry:
+            self._forget(url, entry)
+        return text
+
+    def _request(self, url, headers):
+        with self.metrics.stage("fetch"):
+            if self.session is not None:
+                response = self.session.get(
+                    url, headers=headers, timeout=self.timeout)
+                with self.lock:
+                    self.stats['bytes_downloaded'] += len(response.content)
+                self.metrics.request(url, response.status_code, len(response.content))
+                # Raises for error pages like the 429s of steam, the same as urlopen does
+                if not (200 <= response.status_code < 300 or response.status_code == 304):
+                    response.raise_for_status()
+                return response.status_code, response.text, response.headers
+            try:
+                response = urlopen(
+                    Request(url, headers=headers), timeout=self.timeout)
+            except HTTPError as err:
+                self.metrics.request(url, err.code)
+                if err.code == 304:
+                    return 304, "", err.headers
+                raise
+            data = response.read()
+            with self.lock:
+                self.stats['bytes_downloaded'] += len(data)
+            self.metrics.request(url, response.status, len(data))
+            return response.status, data.decode("utf-8"), response.headers
+
+    def _body_path(self, url):
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_folder, f"{name}.html")
+
+    def _read_body(self, entry):
+        try:
+            with open(entry['file'], "r", encoding="utf-8") as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def _store(self, url, text, headers):
+        path = self._body_path(url)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(text)
+        os.replace(temp_path, path)
+        now = time.time()
+        with self.lock:
+            self.index[url] = {'file': path,
+                               'etag': headers.get('ETag'),
+                               'last_modified': headers.get('Last-Modified'),
+                               'size': len(text.encode("utf-8")),
+                               'fetched': now,
+                               'accessed': now}
+            self.changed = True
+            self._evict()
+
+    def _forget(self, url, entry):
+        with self.lock:
+            if self.index.get(url) is entry:
+                del self.index[url]
+                self.changed = True
+        try:
+            os.remove(entry['file'])
+        except OSError:
+            pass
+
+    def _evict(self):
+        total = sum(entry['size'] for entry in self.index.values())
+        if total <= self.max_bytes:
+            return
+        # Evict down to 90% so the next few stores do not evict again
+        for url, entry in sorted(self.index.items(), key=lambda pair: pair[1]['accessed']):
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(entry['file'])
+            except OSError:
+                pass
+            total -= entry['size']
+            del self.index[url]
+
+    def save(self):
+        """Writes the index to disk, call at the end of each run or cycle"""
+        with self.lock:
+            if not self.changed:
+                return
+            temp_path = f"{self.index_path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(self.index, file)
+            os.replace(temp_path, self.index_path)
+            self.changed = False
+
+    def export_stats(self):
+        """Adds the cache counters since start as gauges to the metrics"""
+        with self.lock:
+            stats = dict(self.stats)
+        for name, value in stats.items():
+            self.metrics.gauge("http_cache", value, counter=name)
+
+    def summary(self):
+        """Returns the hit/miss counters as a printable line"""
+        with self.lock:
+            stats = dict(self.stats)
+        return (f"HTTP cache: {stats['hits']} hits, {stats['revalidated']} revalidated, "
+                f"{stats['misses']} misses, {stats['uncached']} uncached, "
+                f"{stats['bytes_downloaded'] // 1024} kB downloaded, {stats['bytes_saved'] // 1024} kB saved")
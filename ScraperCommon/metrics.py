@@ -0,0 +1,158 @@
+"""Stage timers and counters for the scrapers
+
+A script records how long each stage took, the requests per host and status
+and the bytes downloaded, and exports them after each cycle either as a
+Prometheus textfile (for the node_exporter textfile-collector) or as one
+line appended to a JSON-lines file. The values cover one cycle and are reset
+after the export, the cache and queue gauges are the current totals.
+
+When no metrics_path is configured the scripts get NULL_METRICS, whose
+methods do nothing, so the instrumentation costs a method call at most.
+"""
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+FORMATS = ("prometheus", "jsonl")
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullMetrics(object):
+    """Used when metrics are disabled"""
+    enabled = False
+
+    def stage(self, name):
+        return NULL_STAGE
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def gauge(self, name, value, **labels):
+        pass
+
+    def request(self, url, status, size=0):
+        pass
+
+    def export(self):
+        pass
+
+
+NULL_STAGE = _NullStage()
+NULL_METRICS = NullMetrics()
+
+
+class _Stage(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.metrics.count("stage_seconds", elapsed, stage=self.name)
+        self.metrics.count("stage_calls", 1, stage=self.name)
+        return False
+
+
+class Metrics(object):
+    """Collects the values of one cycle, stage times from worker threads are summed"""
+    enabled = True
+
+    def __init__(self, job, path, output_format="prometheus"):
+        if output_format not in FORMATS:
+            raise ValueError(
+                f"Unknown metrics format {output_format}, use one of {', '.join(FORMATS)}")
+        self.job = job
+        self.path = str(path)
+        self.output_format = output_format
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.cycle_start = time.time()
+
+    def stage(self, name):
+        """Context manager timing one stage"""
+        return _Stage(self, name)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def request(self, url, status, size=0):
+        """Counts a http request by host and status"""
+        host = urlsplit(url).hostname or ""
+        self.count("http_requests", 1, host=host, status=str(status))
+        if size:
+            self.count("http_bytes_downloaded", size, host=host)
+
+    def export(self):
+        """Writes the values of the cycle and starts a new one"""
+        now = time.time()
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            gauges, self.gauges = self.gauges, {}
+            cycle_start, self.cycle_start = self.cycle_start, now
+        gauges[("cycle_seconds", ())] = now - cycle_start
+        gauges[("last_cycle_timestamp", ())] = now
+        if self.output_format == "jsonl":
+            self._write_json_line(now, counters, gauges)
+        else:
+            self._write_textfile(counters, gauges)
+
+    def _write_json_line(self, now, counters, gauges):
+        values = []
+        for kind, entries in (("counter", counters), ("gauge", gauges)):
+            for (name, labels), value in sorted(entries.items()):
+                values.append({'name': name, 'type': kind,
+                               'labels': dict(labels), 'value': value})
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(
+                {'job': self.job, 'timestamp': now, 'metrics': values}) + "\n")
+
+    def _write_textfile(self, counters, gauges):
+        lines = []
+        described = set()
+        for (name, labels), value in sorted(list(counters.items()) + list(gauges.items())):
+            metric = f"scraper_{name}"
+            if metric not in described:
+                lines.append(f"# TYPE {metric} gauge")
+                described.add(metric)
+            label_text = ','.join(
+                f'{key}="{self._escape(value)}"' for key, value in (('job', self.job),) + labels)
+            lines.append(f"{metric}{{{label_text}}} {value}")
+        # The collector may read at any time, so the file is replaced atomically
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def create_metrics(job, settings):
+    """Returns Metrics for the metrics_path/metrics_format settings, NULL_METRICS if not set"""
+    path = settings.get("metrics_path")
+    if not path:
+        return NULL_METRICS
+    return Metrics(job, path, settings.get("metrics_format", "prometheus"))
@@ -0,0 +1,53 @@
+"""Sends the requests of a session to a local replay server
+
+When SCRAPER_REPLAY_URL is set, install() mounts an adapter on a requests
+session that rewrites https://<host>/<path> to <replay-url>/<host>/<path>.
+The response keeps the original url, so cookies are still stored for the
+steam domains and the scripts run unchanged against recorded pages and a
+recording stand-in for discord. See benchmarks/replay_server.py.
+"""
+import os
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+REPLAY_ENV = "SCRAPER_REPLAY_URL"
+
+
+class ReplayAdapter(HTTPAdapter):
+    def __init__(self, replay_url, **kwargs):
+        super().__init__(**kwargs)
+        self.replay_url = replay_url.rstrip('/')
+        self.replay_host = urlsplit(self.replay_url).netloc
+
+    def send(self, request, **kwargs):
+        original = urlsplit(request.url)
+        if original.netloc == self.replay_host:
+            return super().send(request, **kwargs)
+        replayed = request.copy()
+        replayed.url = f"{self.replay_url}/{original.netloc}{original.path}"
+        if original.query:
+            replayed.url += f"?{original.query}"
+        response = super().send(replayed, **kwargs)
+        # The session extracts the cookies and follows redirects from these
+        response.url = request.url
+        response.request = request
+        return response
+
+
+def replay_url():
+    return os.environ.get(REPLAY_ENV) or None
+
+
+def install(session, pool_maxsize=10):
+    """Routes all requests of the session to the replay server if one is configured,
+    returns True if it did"""
+    url = replay_url()
+    if not url:
+        return False
+    adapter = ReplayAdapter(url, pool_maxsize=pool_maxsize)
+    # Adapters mounted for a single host would win over these, being the longer prefix
+    session.adapters.clear()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return True
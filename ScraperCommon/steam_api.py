@@ -0,0 +1,93 @@
+"""Batched calls to the public Steam Web API
+
+Workshop metadata (title, preview, author and update time) for many items
+in one request instead of scraping a page per item. The base url can be
+changed to run against a local stub server.
+"""
+import re
+
+import requests
+
+from metrics import NULL_METRICS
+
+API_BASE_URL = "https://api.steampowered.com"
+# GetPlayerSummaries accepts at most 100 steamids per call
+MAX_PLAYER_SUMMARIES = 100
+
+BBCODE_REPLACEMENTS = [
+    (r'\[(/?)(b|i|u)\]', r'<\1\2>'),
+    (r'\[(/?)strike\]', r'<\1s>'),
+    (r'\[h(\d)\](.*?)\[/h\d\]', r'<div class="bb_h\1">\2</div>'),
+    (r'\[url=([^\]]*)\](.*?)\[/url\]', r'<a href="\1">\2</a>'),
+    (r'\[url\](.*?)\[/url\]', r'<a href="\1">\1</a>'),
+    (r'\[img\](.*?)\[/img\]', r'<img src="\1">'),
+    (r'\[list\]|\[olist\]', '<ul>'),
+    (r'\[/list\]|\[/olist\]', '</ul>'),
+    (r'\[\*\]', '<li>'),
+    (r'\[quote(?:=[^\]]*)?\]', '<blockquote class="bb_blockquote">'),
+    (r'\[/quote\]', '</blockquote>'),
+    (r'\r?\n', '<br/>'),
+    # Everything else, like [spoiler] or [table], is dropped
+    (r'\[/?[a-z]+\d?(?:=[^\]]*)?\]', ''),
+]
+BBCODE_PATTERNS = [(re.compile(pattern, re.IGNORECASE | re.DOTALL), replacement)
+                   for pattern, replacement in BBCODE_REPLACEMENTS]
+
+
+def bbcode_to_html(text):
+    """Converts the bbcode of api descriptions to the html steam shows on its pages"""
+    for pattern, replacement in BBCODE_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class SteamApi(object):
+    """Steam Web API client, the api key is only needed for the player summaries"""
+
+    def __init__(self, session=None, base_url=API_BASE_URL, api_key=None, timeout=30, metrics=None):
+        self.session = session or requests.Session()
+        self.base_url = (base_url or API_BASE_URL).rstrip('/')
+        self.api_key = api_key
+        self.timeout = timeout
+        self.metrics = metrics or NULL_METRICS
+        self.stats = {'calls': 0, 'items': 0}
+
+    def published_file_details(self, wids):
+        """Returns a dict of wid -> details for the items steam returned, in one call"""
+        if not wids:
+            return {}
+        data = {'itemcount': len(wids)}
+        for i, wid in enumerate(wids):
+            data[f'publishedfileids[{i}]'] = wid
+        response = self._call(
+            'post', '/ISteamRemoteStorage/GetPublishedFileDetails/v1/', data=data)
+        details = {}
+        for item in response.get('publishedfiledetails', []):
+            if item.get('result') == 1:
+                details[item['publishedfileid']] = item
+        self.stats['items'] += len(details)
+        return details
+
+    def player_summaries(self, steamids):
+        """Returns a dict of steamid -> summary with personaname, profileurl and avatars,
+        empty without an api key"""
+        steamids = list(dict.fromkeys(steamids))
+        if not self.api_key or not steamids:
+            return {}
+        summaries = {}
+        for start in range(0, len(steamids), MAX_PLAYER_SUMMARIES):
+            response = self._call('get', '/ISteamUser/GetPlayerSummaries/v2/', params={
+                'key': self.api_key, 'steamids': ','.join(steamids[start:start + MAX_PLAYER_SUMMARIES])})
+            for player in response.get('players', []):
+                summaries[player['steamid']] = player
+        return summaries
+
+    def _call(self, method, path, **kwargs):
+        with self.metrics.stage("api"):
+            response = getattr(self.session, method)(
+                self.base_url + path, timeout=self.timeout, **kwargs)
+        self.metrics.request(self.base_url + path,
+                             response.status_code, len(response.content))
+        response.raise_for_status()
+        self.stats['calls'] += 1
+        return response.json().get('response', {})
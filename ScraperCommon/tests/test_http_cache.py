@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import requests
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from http_cache import CachedFetcher  # noqa: E402
+
+URL = "https://steamcommunity.com/sharedfiles/filedetails/?id=1"
+
+
+def response(status, text):
+    result = requests.Response()
+    result.status_code = status
+    result._content = text.encode("utf-8")
+    result.encoding = "utf-8"
+    result.url = URL
+    return result
+
+
+class FakeSession(object):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = 0
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests += 1
+        return self.responses.pop(0)
+
+
+class CachedFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def fetcher(self, session):
+        return CachedFetcher(self.folder.name, {"/filedetails/": 3600}, session=session)
+
+    def test_server_error_is_raised_and_not_cached(self):
+        session = FakeSession(response(500, "error page"), response(200, "item page"))
+        fetcher = self.fetcher(session)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            fetcher.get(URL)
+        self.assertNotIn(URL, fetcher.index)
+        self.assertEqual(fetcher.get(URL), "item page")
+        self.assertEqual(session.requests, 2)
+
+    def test_rate_limit_is_raised(self):
+        fetcher = self.fetcher(FakeSession(response(429, "too many requests")))
+        with self.assertRaises(requests.exceptions.HTTPError):
+            fetcher.get(URL)
+        self.assertNotIn(URL, fetcher.index)
+
+    def test_page_is_cached(self):
+        session = FakeSession(response(200, "item page"))
+        fetcher = self.fetcher(session)
+        self.assertEqual(fetcher.get(URL), "item page")
+        self.assertEqual(fetcher.get(URL), "item page")
+        self.assertEqual(session.requests, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
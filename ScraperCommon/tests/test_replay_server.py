@@ -0,0 +1,60 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from urllib.request import Request, urlopen
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "benchmarks"))
+import replay_server  # noqa: E402
+
+RENDER_PATH = "/steamcommunity.com/comment/PublishedFile_Public/render/76561198000000000/1/"
+
+
+class RecordingsTest(unittest.TestCase):
+    def test_key_ignores_volatile_form_fields(self):
+        url = "https://steamcommunity.com" + RENDER_PATH.split("steamcommunity.com", 1)[1]
+        first = replay_server.Recordings.key("POST", url, b"start=0&count=10&sessionid=aaaa&feature2=-1")
+        second = replay_server.Recordings.key("POST", url, b"start=0&count=10&sessionid=bbbb&feature2=-1")
+        other = replay_server.Recordings.key("POST", url, b"start=10&count=10&sessionid=aaaa&feature2=-1")
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+
+    def test_key_keeps_other_bodies(self):
+        url = "https://api.steampowered.com/IAuthenticationService/GetPasswordRSAPublicKey/v1"
+        self.assertNotEqual(replay_server.Recordings.key("POST", url, b"account_name=a"),
+                            replay_server.Recordings.key("POST", url, b"account_name=b"))
+
+
+class RecordReplayTest(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.forwarded = []
+        forwarded = self.forwarded
+
+        def forward(handler, method, url, body):
+            forwarded.append((method, url, body))
+            return 200, {'Content-Type': "application/json", 'Set-Cookie': []}, json.dumps(
+                {'success': True, 'total_count': 1, 'comments_html': "recorded"}).encode("utf-8")
+
+        original = replay_server.ReplayHandler.forward
+        replay_server.ReplayHandler.forward = forward
+        self.addCleanup(setattr, replay_server.ReplayHandler, "forward", original)
+        self.server, self.url = replay_server.start_server(recordings=folder.name, record=True)
+        self.addCleanup(self.server.shutdown)
+
+    def post(self, body):
+        with urlopen(Request(self.url + RENDER_PATH, data=body), timeout=10) as response:
+            return json.loads(response.read())
+
+    def test_post_replayed_with_another_sessionid(self):
+        recorded = self.post(b"start=0&count=10&sessionid=aaaa&feature2=-1")
+        replayed = self.post(b"start=0&count=10&sessionid=bbbb&feature2=-1")
+        self.assertEqual(recorded['comments_html'], "recorded")
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(len(self.forwarded), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Persistent cache of workshop authors for the embed author-field
+
+Maps the author profile-url (or name when the url is unknown) to the avatar
+and profile link, entries are refreshed after a TTL and the least recently
+used are evicted when the cache is full
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class AuthorCache(object):
+    path = None
+    ttl = None
+    maxEntries = None
+    entries = None
+    lock = None
+    changed = False
+
+    def __init__(self, path, ttlHours=168, maxEntries=1000):
+        self.path = path
+        self.ttl = ttlHours * 3600
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        if os.path.isfile(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    # Saved in least recently used order
+                    for key, entry in json.load(f):
+                        self.entries[key] = entry
+            except (ValueError, TypeError) as e:
+                print(f"Ignoring broken author cache {path}: {e}")
+
+    def get(self, authorPage, authorName):
+        """Returns dict with authorImage and authorPage or None if unknown or expired.
+        The name is only used when the profile-url is unknown, display names are not unique"""
+        key = authorPage or authorName
+        with self.lock:
+            if not key or key not in self.entries:
+                return None
+            entry = self.entries[key]
+            if time.time() - entry['fetched'] > self.ttl:
+                del self.entries[key]
+                self.changed = True
+                return None
+            self.entries.move_to_end(key)
+            self.changed = True
+            return entry
+
+    def put(self, authorPage, authorName, authorImage, profilePage):
+        entry = {'authorImage': authorImage,
+                 'authorPage': profilePage, 'fetched': time.time()}
+        key = authorPage or authorName
+        with self.lock:
+            if key:
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+            self.changed = True
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            tempPath = f"{self.path}.tmp"
+            with open(tempPath, "w", encoding="utf-8") as f:
+                json.dump(list(self.entries.items()), f)
+            os.replace(tempPath, self.path)
+            self.changed = False
@@ -0,0 +1,110 @@
+"""Index of the subscribed mods in the local steam workshop folder
+
+Replaces the About.xml check per updated item with a set lookup. The folder
+is scanned once and the result saved, later refreshes only look at the mod
+folders that were added or changed since, and skip the scan completely when
+the workshop folder itself has not changed. Mod folders without an About.xml
+may still be downloading, their About.xml is checked on every refresh
+"""
+import json
+import os
+import threading
+
+
+class SubscriptionIndex(object):
+    workshopPath = None
+    path = None
+    workshopModified = None
+    entries = None
+    subscribed = None
+    lock = None
+    changed = False
+
+    def __init__(self, workshopPath, path):
+        self.workshopPath = str(workshopPath)
+        self.path = path
+        self.lock = threading.Lock()
+        # wid -> [newest mtime of the mod and its About folder, has About/About.xml]
+        self.entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get('workshopPath') == self.workshopPath:
+                    self.workshopModified = data['workshopModified']
+                    self.entries = data['entries']
+            except (ValueError, TypeError, KeyError) as e:
+                print(f"Ignoring broken subscription index {path}: {e}")
+        self.subscribed = set(
+            wid for wid, entry in self.entries.items() if entry[1])
+
+    def refresh(self):
+        """Rescans the workshop folder if it changed, returns the number of mod folders checked"""
+        modified = os.stat(self.workshopPath).st_mtime
+        if modified == self.workshopModified:
+            return self._refreshPending()
+        checked = 0
+        entries = {}
+        for entry in os.scandir(self.workshopPath):
+            if not entry.is_dir():
+                continue
+            folderModified = _folderModified(entry.path)
+            known = self.entries.get(entry.name)
+            if known and known[1] and known[0] == folderModified:
+                entries[entry.name] = known
+                continue
+            entries[entry.name] = [folderModified, os.path.isfile(
+                os.path.join(entry.path, "About", "About.xml"))]
+            checked += 1
+        with self.lock:
+            self.entries = entries
+            self.subscribed = set(
+                wid for wid, entry in entries.items() if entry[1])
+            self.workshopModified = modified
+            self.changed = True
+        return checked
+
+    def _refreshPending(self):
+        # Folders without an About.xml may still be downloading, only those are checked again.
+        # Their About.xml is looked for directly, creating it does not change the mod folder mtime
+        checked = 0
+        for wid, entry in list(self.entries.items()):
+            if entry[1]:
+                continue
+            folder = os.path.join(self.workshopPath, wid)
+            if not os.path.isfile(os.path.join(folder, "About", "About.xml")):
+                continue
+            try:
+                folderModified = _folderModified(folder)
+            except OSError:
+                continue
+            checked += 1
+            with self.lock:
+                self.entries[wid] = [folderModified, True]
+                self.subscribed.add(wid)
+                self.changed = True
+        return checked
+
+    def isSubscribed(self, wid):
+        return wid in self.subscribed
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            tempPath = f"{self.path}.tmp"
+            with open(tempPath, "w", encoding="utf-8") as f:
+                json.dump({'workshopPath': self.workshopPath,
+                           'workshopModified': self.workshopModified, 'entries': self.entries}, f)
+            os.replace(tempPath, self.path)
+            self.changed = False
+
+
+def _folderModified(folder):
+    """Newest mtime of a mod folder and its About folder, a file added to
+    About/ only changes the mtime of About/"""
+    modified = os.stat(folder).st_mtime
+    try:
+        return max(modified, os.stat(os.path.join(folder, "About")).st_mtime)
+    except OSError:
+        return modified
@@ -0,0 +1,72 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from subscription_index import SubscriptionIndex  # noqa: E402
+
+
+class SubscriptionIndexTest(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.workshopPath = os.path.join(folder.name, "294100")
+        self.indexPath = os.path.join(folder.name, "subscriptions.json")
+        os.makedirs(self.workshopPath)
+
+    def addMod(self, wid, about=True):
+        os.makedirs(os.path.join(self.workshopPath, wid, "About"))
+        if about:
+            self.addAbout(wid)
+
+    def addAbout(self, wid):
+        with open(os.path.join(self.workshopPath, wid, "About", "About.xml"), "w", encoding="utf-8") as f:
+            f.write("<ModMetaData/>")
+
+    def test_scan(self):
+        self.addMod("1")
+        self.addMod("2", about=False)
+        index = SubscriptionIndex(self.workshopPath, self.indexPath)
+        self.assertEqual(index.refresh(), 2)
+        self.assertTrue(index.isSubscribed("1"))
+        self.assertFalse(index.isSubscribed("2"))
+
+    def test_about_created_after_first_scan(self):
+        # Steam creates the About folder first and About.xml later while downloading
+        self.addMod("1", about=False)
+        index = SubscriptionIndex(self.workshopPath, self.indexPath)
+        index.refresh()
+        self.assertFalse(index.isSubscribed("1"))
+        modFolder = os.path.join(self.workshopPath, "1")
+        folderModified = os.stat(modFolder).st_mtime
+        self.addAbout("1")
+        self.assertEqual(os.stat(modFolder).st_mtime, folderModified)
+        index.refresh()
+        self.assertTrue(index.isSubscribed("1"))
+
+    def test_about_created_before_full_rescan(self):
+        self.addMod("1", about=False)
+        index = SubscriptionIndex(self.workshopPath, self.indexPath)
+        index.refresh()
+        index.save()
+        self.addAbout("1")
+        # A new mod folder changes the workshop folder, so the next start rescans it all
+        self.addMod("2")
+        index = SubscriptionIndex(self.workshopPath, self.indexPath)
+        index.refresh()
+        self.assertTrue(index.isSubscribed("1"))
+        self.assertTrue(index.isSubscribed("2"))
+
+    def test_unchanged_folders_are_not_checked_again(self):
+        self.addMod("1")
+        index = SubscriptionIndex(self.workshopPath, self.indexPath)
+        index.refresh()
+        index.save()
+        index = SubscriptionIndex(self.workshopPath, self.indexPath)
+        self.assertEqual(index.refresh(), 0)
+        self.assertTrue(index.isSubscribed("1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,22 +1,43 @@
-from bs4 import BeautifulSoup
-from urllib.request import urlopen
 import os.path
 from pathlib import Path
-import time
-from discord_webhook import DiscordWebhook, DiscordEmbed
+from discord_webhook import DiscordEmbed
 from datetime import datetime as datetimesub, timedelta
 from dateutil.parser import parser
 import os
 import glob
 import sys
 import re
-import uuid
 import json
-import sys
+import signal
+import threading
+import time
+import traceback
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from workshop_state import WorkshopState, HOUR_FORMAT
+from author_cache import AuthorCache
+from subscription_index import SubscriptionIndex
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), "ScraperCommon"))
+from http_cache import CachedFetcher
+import html_parsing
+from discord_delivery import DiscordOutbox
+from steam_api import SteamApi, bbcode_to_html
+from metrics import create_metrics
+import replay
 
+# --daemon keeps running with its own schedule, --config=<path> reads another config-file,
+# any other argument runs once in test mode
+daemon = "--daemon" in sys.argv[1:]
+configArguments = [argument for argument in sys.argv[1:]
+                   if argument.startswith("--config=")]
 test = False
-if (len(sys.argv) > 1):
+if (len([argument for argument in sys.argv[1:] if argument != "--daemon" and argument not in configArguments]) > 0):
     test = True
+if test and daemon:
+    print("Test mode only runs once, ignoring --daemon")
+    daemon = False
 
 
 def read_json(file_path):
@@ -26,6 +47,8 @@ def read_json(file_path):
 
 config_path = Path(
     f"{os.path.dirname(os.path.realpath(__file__))}/workshop_scraper.json")
+if configArguments:
+    config_path = Path(configArguments[-1].split("=", 1)[1])
 if (not os.path.isfile(config_path)):
     print(f"No config-file found: {config_path}, create and try again")
     sys.exit()
@@ -39,35 +62,92 @@ if (test):
     updatedDiscord = settings["discord_test_channel"]
 
 newModsUrl = settings["steam_new_mods_search_url"]
-updatedModsUrl = settings["steam_updated_mods_search_url"]
-updatedModsUrl = updatedModsUrl + \
-    str(int((datetimesub.now() - timedelta(minutes=10)).timestamp()))
-currentDigest = datetimesub.now().hour
+updatedModsSearchUrl = settings["steam_updated_mods_search_url"]
 
 cachePath = settings["caching_folder"]
 digestTitle = settings["digest_title"]
 maxPostsPerHour = settings["discord_posts_per_hour"]
 steamWorkshopPath = settings["steam_workshop_path"]
+fetchWorkers = max(1, int(settings.get("fetch_workers", 8)))
+stateRetentionDays = settings.get("state_retention_days", 90)
+searchPageExtraction = settings.get("search_page_extraction", True)
+authorCacheHours = settings.get("author_cache_hours", 168)
+authorCacheSize = settings.get("author_cache_size", 1000)
+httpCacheTtls = settings.get("http_cache_ttls", {
+    "/filedetails/changelog/": 0, "/sharedfiles/filedetails/": 3600})
+httpCacheMegabytes = settings.get("http_cache_megabytes", 50)
+discordFlushSeconds = settings.get("discord_flush_seconds", 120)
+packEmbeds = settings.get("discord_pack_embeds", True)
+mergeChangenotes = settings.get("merge_changenotes", False)
+html_parsing.select_backend(settings.get("html_parser", "auto"))
+metrics = create_metrics("workshop_scraper", settings)
+html_parsing.set_metrics(metrics)
+# "api" reads title, preview, author and update time from the web-api, "html" from the pages
+useApi = settings.get("metadata_source", "html") == "api"
+steamApiKey = settings.get("steam_api_key")
+steamApiBaseUrl = settings.get("steam_api_base_url")
+maxSearchPages = max(1, int(settings.get("max_search_pages", 5)))
+# Items on a full search page, a shorter page is the last one
+searchPageSize = 30
+daemonNewMinutes = settings.get("daemon_new_minutes", 10)
+daemonUpdatedMinutes = settings.get("daemon_updated_minutes", 10)
+
+# Replaces my own description header/footer-images in the changenotes
+myInfoPattern = re.compile(
+    r'<img src="https://i\.imgur\.com/pufA0kM\.png">.*<img src="https://i\.imgur\.com/Z4GOv8H\.png">')
+myFooterPattern = re.compile(r'<img src="https://i\.imgur\.com/PwoNOj4\.png">.*')
+# Stop at the end of their own tag, so several links or images on a line are kept apart
+linkPattern = re.compile(
+    r'<a\b[^>]*?\bhref="(?P<link>[^"]*)"[^>]*>(?P<text>[^<]*)</a>')
+headerPattern = re.compile(r'<div class="bb_h.">(?P<text>.*?)</div>')
+authorPattern = re.compile(r'<div class="bb_quoteauthor">(?P<text>.*?)</div>')
+imagePattern = re.compile(r'<img\b[^>]*?\bsrc="(?P<link>[^"]*)"[^>]*>')
+externalLinkPattern = re.compile(r'<span class="bb_link_host">.*?</span>')
+autogenPattern = re.compile(r'\[Auto-generated text\].*?\.')
+hoverDataPattern = re.compile(
+    r'SharedFileBindMouseHover\(\s*"sharedfile_(\d+)"\s*,\s*\w+\s*,\s*')
+# Discord limits per webhook message
+maxEmbedsPerMessage = 10
+maxMessageCharacters = 6000
+maxDescriptionCharacters = 4000
 
 digestPath = f"{cachePath}/digest"
 updatedPath = f"{cachePath}/updated"
 newPath = f"{cachePath}/new"
 embedsPath = f"{cachePath}/embeds"
-embedsUpdatedPath = f"{embedsPath}/updated"
-embedsNewPath = f"{embedsPath}/new"
 
 if not os.path.exists(Path(digestPath)):
     os.makedirs(Path(digestPath))
-if not os.path.exists(Path(updatedPath)):
-    os.makedirs(Path(updatedPath))
-if not os.path.exists(Path(newPath)):
-    os.makedirs(Path(newPath))
-if not os.path.exists(Path(embedsUpdatedPath)):
-    os.makedirs(Path(embedsUpdatedPath))
-if not os.path.exists(Path(embedsNewPath)):
-    os.makedirs(Path(embedsNewPath))
 onlyLocal = steamWorkshopPath and os.path.exists(Path(steamWorkshopPath))
 
+state = WorkshopState(Path(f"{cachePath}/state.db"))
+migratedMarkers = state.migrateMarkers(Path(newPath), Path(updatedPath))
+if migratedMarkers > 0:
+    print(f"Migrated {migratedMarkers} reported-markers to the state database")
+migratedEmbeds = state.migrateEmbeds(
+    Path(embedsPath), datetimesub.now().strftime(HOUR_FORMAT))
+if migratedEmbeds > 0:
+    print(f"Migrated {migratedEmbeds} queued embeds to the state database")
+expiredEntries = state.expire(stateRetentionDays)
+if expiredEntries > 0:
+    print(f"Expired {expiredEntries} old entries from the state database")
+authorCache = AuthorCache(
+    Path(f"{cachePath}/authors.json"), authorCacheHours, authorCacheSize)
+subscriptions = None
+if onlyLocal:
+    subscriptions = SubscriptionIndex(
+        Path(steamWorkshopPath), Path(f"{cachePath}/subscriptions.json"))
+# One keep-alive session for all steam requests, sized for the fetch workers
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_maxsize=fetchWorkers))
+replay.install(session, fetchWorkers)
+fetcher = CachedFetcher(Path(f"{cachePath}/http"),
+                        httpCacheTtls, httpCacheMegabytes * 1024 * 1024, session, metrics=metrics)
+steamApi = SteamApi(session, steamApiBaseUrl, steamApiKey, metrics=metrics)
+outbox = DiscordOutbox(Path(f"{cachePath}/outbox.db"), metrics=metrics)
+replay.install(outbox.session)
+outbox.start()
+
 
 def postOldDigest(webhookurl):
     lastDigest = (datetimesub.now() - timedelta(hours=1)).hour
@@ -84,228 +164,476 @@ def postOldDigest(webhookurl):
             count = count + 1
             description = description + \
                 f"[{lineSplitted[0]}]({lineSplitted[2]}) {lineSplitted[1]}\n"
-        embed = DiscordEmbed(title=digestTitle)
-        embed.add_embed_field(
-            name=f"{count} mods", value=description.rstrip(), inline=True)
-        webhook = DiscordWebhook(url=webhookurl)
-        webhook.add_embed(embed)
-        response = webhook.execute()
+        embed = {'title': digestTitle, 'fields': [
+            {'name': f"{count} mods", 'value': description.rstrip(), 'inline': True}]}
+        outbox.enqueue(webhookurl, {'embeds': [embed]},
+                       key=f"digest{lastDigest}-{os.path.getmtime(fileName)}")
         os.remove(fileName)
 
 
 def postDiscordMessages(url, updated):
-    lastHour = (datetimesub.now() - timedelta(hours=1)).hour
-    thisHour = (datetimesub.now()).hour
-    if updated:
-        oldName = Path(f'{embedsPath}/update{lastHour}')
-        currentName = Path(f'{embedsPath}/update{thisHour}')
-        path = Path(embedsUpdatedPath)
-    else:
-        oldName = Path(f'{embedsPath}/new{lastHour}')
-        currentName = Path(f'{embedsPath}/new{thisHour}')
-        path = Path(embedsNewPath)
-    if os.path.isfile(oldName):
-        os.remove(oldName)
-    if (not os.path.isfile(currentName)):
-        Path(currentName).touch()
-        with open(currentName, 'a', encoding="utf-8") as the_file:
-            the_file.write('0')
-    with open(currentName, 'r', encoding="utf-8") as the_file:
-        currentPosts = int(the_file.read())
-    files = list(filter(os.path.isfile, path.glob('*')))
-    files.sort(key=lambda x: os.path.getmtime(x))
-    for file in files:
-        if currentPosts > maxPostsPerHour:
-            break
-        sendEmbed(file, url)
-        currentPosts = currentPosts + 1
-    with open(currentName, 'w', encoding="utf-8") as the_file:
-        the_file.write(f'{currentPosts}')
+    channel = "updated" if updated else "new"
+    hour = datetimesub.now().strftime(HOUR_FORMAT)
+    currentPosts = state.postsInHour(channel, hour)
+    if currentPosts > maxPostsPerHour:
+        return
+    # Packs as many embeds per message as discord allows, each message counts as one post
+    embedsPerMessage = maxEmbedsPerMessage if packEmbeds else 1
+    queued = state.peekEmbeds(
+        channel, (maxPostsPerHour + 1 - currentPosts) * embedsPerMessage)
+    batch = []
+    batchLength = 0
+    for seq, data in queued:
+        embed = loadEmbed(data)
+        length = embedLength(embed)
+        if batch and (len(batch) == embedsPerMessage or batchLength + length > maxMessageCharacters):
+            sendEmbeds(channel, hour, batch, url)
+            currentPosts = currentPosts + 1
+            batch = []
+            batchLength = 0
+            if currentPosts > maxPostsPerHour:
+                break
+        batch.append((seq, embed))
+        batchLength = batchLength + length
+    if batch:
+        sendEmbeds(channel, hour, batch, url)
 
 
 def saveToDigest(title, author, link):
-    fileName = Path(f'{digestPath}/{currentDigest}')
+    fileName = Path(f'{digestPath}/{datetimesub.now().hour}')
     if (not os.path.isfile(fileName)):
         Path(fileName).touch()
     with open(fileName, 'a', encoding="utf-8") as the_file:
         the_file.write(f'{title}|{author}|{link}\n')
 
 
-def saveEmbed(embed, folder):
-    tempname = str(uuid.uuid4())
-    fileName = f'{embedsPath}/{folder}/{tempname}'
-    Path(fileName).touch()
+def saveEmbed(embed, channel, wid=None):
     data = {'title': embed.title, 'url': embed.url, 'author': {
         'name': embed.author['name'], 'url': embed.author['url'], 'icon_url': embed.author['icon_url']}, 'description': embed.description, 'thumbnail': embed.thumbnail['url']}
-    text = json.dumps(data)
-    with open(fileName, 'a', encoding="utf-8") as the_file:
-        the_file.write(text)
+    state.queueEmbed(channel, json.dumps(data), wid,
+                     mergeEmbeds if mergeChangenotes else None)
 
 
-def sendEmbed(filepath, url):
-    with open(filepath, 'r', encoding="utf-8") as the_file:
-        embedText = the_file.read()
+def mergeEmbeds(oldText, newText):
+    # Adds the changenote of a superseded update below the latest one
+    oldJson = json.loads(oldText)
+    newJson = json.loads(newText)
+    if oldJson['description'] and oldJson['description'] not in (newJson['description'] or ''):
+        earlier = oldJson['description'].replace(
+            "**Changenote**", "**Earlier changenote**", 1)
+        merged = f"{newJson['description'] or ''}\n\n{earlier}".strip()
+        newJson['description'] = merged[0:maxDescriptionCharacters]
+    return json.dumps(newJson)
+
+
+def loadEmbed(embedText):
     embedJson = json.loads(embedText)
-    embed = DiscordEmbed(title=embedJson['title'], url=embedJson['url'])
-    embed.set_author(name=embedJson['author']['name'], url=embedJson['author']
-                     ['url'], icon_url=embedJson['author']['icon_url'])
-    embed.description = embedJson['description']
-    embed.set_thumbnail(url=embedJson['thumbnail'])
-    webhook = DiscordWebhook(url=url)
-    webhook.add_embed(embed)
-    response = webhook.execute()
-    print(response)
-    os.remove(filepath)
-    time.sleep(1)
+    embed = {'title': embedJson['title'], 'url': embedJson['url'],
+             'author': embedJson['author'], 'thumbnail': {'url': embedJson['thumbnail']}}
+    if embedJson['description']:
+        embed['description'] = embedJson['description']
+    return embed
+
+
+def embedLength(embed):
+    # Discord counts these fields against the total characters of a message
+    return len(embed['title'] or '') + len(embed.get('description') or '') + len(embed['author']['name'] or '')
+
+
+def sendEmbeds(channel, hour, batch, url):
+    # Keyed on the first queued embed so a crash before the acknowledgement can not
+    # queue them twice, the embeds are packed the same way again on the next run
+    outbox.enqueue(url, {'embeds': [embed for _, embed in batch]},
+                   key=f"embed{channel}{batch[0][0]}")
+    state.ackEmbeds(channel, [seq for seq, _ in batch], hour)
 
 
 def htmlToDiscord(message):
-    linkFilter = '<a.*(?:href=")(?P<link>[^"]*)[^>]*>(?P<text>[^<]*)<\/a>'
-    headerFilter = '<div class="bb_h.">(?P<text>.*)<\/div>'
-    authorFilter = '<div class="bb_quoteauthor">(?P<text>.*)<\/div>'
-    autogenFilter = '\[Auto\-generated text\].*\.'
-    imageFilter = '<img.*src="(?P<link>.*)"*.>'
-    externalLinkFilter = '<span class="bb_link_host">.*<\/span>'
-    myInfo = '<img src="https://i.imgur.com/pufA0kM.png">.*<img src="https://i.imgur.com/Z4GOv8H.png">'
-    myFooter = '<img src="https://i.imgur.com/PwoNOj4.png">.*'
-    message = re.sub(myInfo, r'```\nOriginal Description\n```', message)
-    message = re.sub(myFooter, r'', message)
-    message = message.replace(
-        '<img src="https://i.imgur.com/buuPQel.png">', '')
-    message = message.replace('<br/><br/><br/>', '<br/><br/>')
-    message = message.replace('<br/>', '\n').replace('\\n', '\n')
-    message = message.replace('<i>', '*').replace('</i>', '*')
-    message = message.replace('<b>', '**').replace('</b>', '**')
-    message = message.replace('<u>', '__').replace('</u>', '__')
-    message = message.replace('<s>', '~~').replace('</s>', '~~')
-    message = message.replace('<li>', '* ').replace('</li>', '')
-    message = message.replace(
-        '⦿', '*').replace('•', '*').replace('https://steamcommunity.com/linkfilter/?url=', '')
-    message = message.replace('target="_blank"', '').replace(
-        'rel="noreferrer"', '').replace('class="bb_link"', '')
-    message = message.replace('<ul>', '').replace(
-        '<ul class="bb_ul">', '').replace('</ul>', '')
-    message = message.replace('</img>', '').replace('&amp;', '&')
-    message = message.replace('&lt;', '<').replace('&gt;', '>')
-    message = message.replace(
-        '<blockquote class="bb_blockquote with_author">', '>>> ')
-    message = message.replace('</blockquote>', '')
-    message = re.sub(linkFilter, r'[\g<text>](\g<link>)', message)
-    message = re.sub(headerFilter, r'> \g<text>\n', message)
-    message = re.sub(authorFilter, r'\[\g<text>\]\n', message)
-    message = re.sub(imageFilter, r'\g<link>', message)
-    message = re.sub(externalLinkFilter, '', message)
-    message = re.sub(autogenFilter, '', message)
-    message = message.replace('</div>', '').replace('</di', '')
-    if (len(message) > 4000):
-        message = message[0:4000]
-    return message
-
-
-def generateDiscordPost(each_div, script, webhookurl, updated):
-    link = each_div.findAll("a", {"class": "ugc"})[0]['href'].split('&')[0]
+    with metrics.stage("translate"):
+        message = myInfoPattern.sub(r'```\nOriginal Description\n```', message)
+        message = myFooterPattern.sub(r'', message)
+        message = message.replace(
+            '<img src="https://i.imgur.com/buuPQel.png">', '')
+        message = message.replace('<br/><br/><br/>', '<br/><br/>')
+        message = message.replace('<br/>', '\n').replace('\\n', '\n')
+        message = message.replace('<i>', '*').replace('</i>', '*')
+        message = message.replace('<b>', '**').replace('</b>', '**')
+        message = message.replace('<u>', '__').replace('</u>', '__')
+        message = message.replace('<s>', '~~').replace('</s>', '~~')
+        message = message.replace('<li>', '* ').replace('</li>', '')
+        message = message.replace(
+            '⦿', '*').replace('•', '*').replace('https://steamcommunity.com/linkfilter/?url=', '')
+        message = message.replace('target="_blank"', '').replace(
+            'rel="noreferrer"', '').replace('class="bb_link"', '')
+        message = message.replace('<ul>', '').replace(
+            '<ul class="bb_ul">', '').replace('</ul>', '')
+        message = message.replace('</img>', '').replace('&amp;', '&')
+        message = message.replace('&lt;', '<').replace('&gt;', '>')
+        message = message.replace(
+            '<blockquote class="bb_blockquote with_author">', '>>> ')
+        message = message.replace('</blockquote>', '')
+        message = linkPattern.sub(r'[\g<text>](\g<link>)', message)
+        message = headerPattern.sub(r'> \g<text>\n', message)
+        message = authorPattern.sub(r'\[\g<text>\]\n', message)
+        message = imagePattern.sub(r'\g<link>', message)
+        message = externalLinkPattern.sub('', message)
+        message = autogenPattern.sub('', message)
+        message = message.replace('</div>', '').replace('</di', '')
+        return message[0:maxDescriptionCharacters]
+
+
+def fetchPage(url):
+    return fetcher.get(url)
+
+
+def getItemLink(each_div):
+    return each_div.findAll("a", {"class": "ugc"})[0]['href'].split('&')[0]
+
+
+def fetchDetails(wids):
+    """Gets the details of all items with one call to the public web-api.
+    Returns a dict of wid -> details, empty if the call failed"""
+    try:
+        return steamApi.published_file_details(wids)
+    except Exception as e:
+        print(f"Could not fetch item details, using the pages instead: {e}")
+        return {}
+
+
+def fetchAuthors(details):
+    """Gets the profiles of the item creators with one call per 100 authors.
+    Returns a dict of steamid -> player summary, empty without an api key"""
+    try:
+        return steamApi.player_summaries(
+            [itemDetails['creator'] for itemDetails in details.values() if itemDetails.get('creator')])
+    except Exception as e:
+        print(f"Could not fetch authors, using the pages instead: {e}")
+        return {}
+
+
+def getUpdateTime(details, wid):
+    itemDetails = details.get(wid)
+    if itemDetails and 'time_updated' in itemDetails:
+        return str(float(itemDetails['time_updated']))
+    return None
+
+
+def parseChangelogDate(changelogSoup):
+    datetag = changelogSoup.find("div", {"class": "workshopAnnouncement"}).find(
+        "div", {"class": "changelog"}).text.strip().replace("Update: ", "")
+    firstPart = datetag.split('@')[0].strip()
+    if (firstPart.count(',') == 0):
+        firstPart = firstPart + " " + str(datetimesub.now().year)
+    lastPart = datetag.split('@')[-1].strip()
+    lastUpdatedString = firstPart + " " + lastPart
+    date_parser = parser()
+    return str(date_parser.parse(lastUpdatedString).timestamp())
+
+
+def fetchItem(each_div, updated, details, pageData, authors):
+    """Fetches the pages needed for one search result, runs in the worker pool.
+    Returns None if the item should be skipped"""
+    link = getItemLink(each_div)
     wid = link.split('=')[1]
-    description = ""
+    item = {'link': link, 'wid': wid}
     if updated:
-        if onlyLocal and not os.path.isfile(Path(f'{steamWorkshopPath}/' + wid + '/About/About.xml')):
-            print(wid + " is not subscribed, ignoring")
-            return
-        changelogPage = urlopen(
-            "https://steamcommunity.com/sharedfiles/filedetails/changelog/" + wid)
-        changelogData = changelogPage.read().decode("utf-8")
-        changelogSoup = BeautifulSoup(changelogData, "html.parser")
-        datetag = changelogSoup.find("div", {"class": "workshopAnnouncement"}).find(
-            "div", {"class": "changelog"}).text.strip().replace("Update: ", "")
-        firstPart = datetag.split('@')[0].strip()
-        if (firstPart.count(',') == 0):
-            firstPart = firstPart + " " + str(datetimesub.now().year)
-        lastPart = datetag.split('@')[-1].strip()
-        lastUpdatedString = firstPart + " " + lastPart
-        date_parser = parser()
-        lastUpdated = str(date_parser.parse(lastUpdatedString).timestamp())
-        if not test and os.path.isfile(Path(f'{updatedPath}/' + wid + lastUpdated)):
+        # Check the cheap api-timestamp first so repeats never download the changelog
+        lastUpdated = getUpdateTime(details, wid)
+        if lastUpdated and not test and state.isUpdateReported(wid, lastUpdated):
             print(wid + " is already reported, ignoring")
-            return
+            return None
+        changelogData = fetchPage(
+            "https://steamcommunity.com/sharedfiles/filedetails/changelog/" + wid)
+        changelogSoup = html_parsing.parse(
+            changelogData, html_parsing.CHANGELOG_PAGE)
+        if not lastUpdated:
+            lastUpdated = parseChangelogDate(changelogSoup)
+            if not test and state.isUpdateReported(wid, lastUpdated):
+                print(wid + " is already reported, ignoring")
+                return None
+        item['changelogSoup'] = changelogSoup
+        item['lastUpdated'] = lastUpdated
     else:
-        if not test and os.path.isfile(Path(f'{newPath}/' + wid)):
+        if not test and state.isNewReported(wid):
             print(wid + " is already reported, ignoring")
-            return
-    title = each_div.findAll(
+            return None
+    item['title'] = each_div.findAll(
         "div", {"class": "workshopItemTitle ellipsis"})[0].text
-    image = each_div.findAll(
+    item['image'] = each_div.findAll(
         "img", {"class": "workshopItemPreviewImage aspectratio_16x9"})[0]['src']
-    authorName = each_div.findAll(
-        "div", {"class": "workshopItemAuthorName ellipsis"})[0].find("a").text
-    modPage = urlopen(
-        "https://steamcommunity.com/sharedfiles/filedetails/" + wid)
-    modData = modPage.read().decode("utf-8")
-    modSoup = BeautifulSoup(modData, "html.parser")
-    authorImage = modSoup.findAll("div", {"class": "playerAvatar"})[
-        0].find("img").attrs['src']
-    authorPage = modSoup.findAll("a", class_="friendBlockLinkOverlay")[
-        0].attrs['href']
+    authorLink = each_div.findAll(
+        "div", {"class": "workshopItemAuthorName ellipsis"})[0].find("a")
+    item['authorName'] = authorLink.text
+    if searchPageExtraction:
+        if authorLink.has_attr('href'):
+            item['authorPage'] = authorLink['href'].split(
+                '/myworkshopfiles')[0]
+        data = pageData.get(wid)
+        if data:
+            if data.get('title'):
+                item['title'] = data['title']
+            if not updated and data.get('description'):
+                item['description'] = data['description']
+    itemDetails = details.get(wid) if useApi else None
+    if itemDetails:
+        if itemDetails.get('title'):
+            item['title'] = itemDetails['title']
+        if itemDetails.get('preview_url'):
+            item['image'] = itemDetails['preview_url']
+        if not updated and itemDetails.get('description'):
+            item['description'] = bbcode_to_html(itemDetails['description'])
+        author = authors.get(itemDetails.get('creator'))
+        if author:
+            item['authorName'] = author['personaname']
+            item['authorPage'] = author['profileurl'].rstrip('/')
+            item['authorImage'] = author['avatarmedium']
+    listedAuthorPage = item.get('authorPage')
+    if not item.get('authorImage'):
+        cachedAuthor = authorCache.get(listedAuthorPage, item['authorName'])
+        if cachedAuthor:
+            item['authorImage'] = cachedAuthor['authorImage']
+            item['authorPage'] = cachedAuthor['authorPage']
+    # Only fetch the mod-page for the fields the search page or cache did not contain
+    if not item.get('authorImage') or not item.get('authorPage') or (not updated and 'description' not in item):
+        modData = fetchPage(
+            "https://steamcommunity.com/sharedfiles/filedetails/" + wid)
+        modSoup = html_parsing.parse(modData, html_parsing.MOD_PAGE)
+        item['authorImage'] = modSoup.findAll("div", {"class": "playerAvatar"})[
+            0].find("img").attrs['src']
+        item['authorPage'] = modSoup.findAll("a", class_="friendBlockLinkOverlay")[
+            0].attrs['href']
+        authorCache.put(listedAuthorPage, item['authorName'],
+                        item['authorImage'], item['authorPage'])
+        if not updated and 'description' not in item:
+            item['description'] = modSoup.find(
+                "div", {"class": "workshopItemDescription"}).encode_contents().decode()
+    return item
+
+
+def generateDiscordPost(item, updated):
+    link = item['link']
+    wid = item['wid']
+    title = item['title']
+    authorName = item['authorName']
+    description = ""
     embed = DiscordEmbed(title=title, url=link)
-    embed.set_author(name=authorName, url=authorPage, icon_url=authorImage)
+    embed.set_author(name=authorName,
+                     url=item['authorPage'], icon_url=item['authorImage'])
     if updated:
+        lastUpdated = item['lastUpdated']
         description = htmlToDiscord(
-            changelogSoup.find("p").encode_contents().decode())
+            item['changelogSoup'].find("p").encode_contents().decode())
         if len(description) > 0:
             description = f"**Changenote**\n{description}"
             embed.description = description
         else:
             if not test:
                 saveToDigest(title, authorName, link)
-                Path(f'{updatedPath}/' + wid + lastUpdated).touch()
+                state.markUpdated(wid, lastUpdated)
             else:
                 print(wid + " has no changelog, would add to digest instead")
             return
     else:
-        description = htmlToDiscord(modSoup.find(
-            "div", {"class": "workshopItemDescription"}).encode_contents().decode())
+        description = htmlToDiscord(item['description'])
         if len(description) > 0:
             embed.description = description
-    embed.set_thumbnail(url=image)
+    embed.set_thumbnail(url=item['image'])
 
     if updated:
-        saveEmbed(embed, "updated")
+        # Keeps only the latest queued update of a mod when posting is throttled
+        saveEmbed(embed, "updated", wid)
         if not test:
-            Path(f'{updatedPath}/' + wid + lastUpdated).touch()
+            state.markUpdated(wid, lastUpdated)
     else:
         saveEmbed(embed, "new")
         if not test:
-            Path(f'{newPath}/' + wid).touch()
-
-
-postOldDigest(updatedDiscord)
-
-if (newModsUrl):
-    page = urlopen(newModsUrl)
-    htmldata = page.read().decode("utf-8")
-    soup = BeautifulSoup(htmldata, "html.parser")
-    pattern = re.compile('description":"[^"]+"', re.MULTILINE)
-    workshopItems = soup.findAll("div", {"class": "workshopItem"})
-    scripts = soup.findAll("script", text=pattern)
-    print(f"{len(workshopItems)} workshop items, {len(scripts)} scripts")
-    for i in range(len(workshopItems) - 1):
-        if (test and i >= 10):
-            print(f"Only testing, will only print {i}")
+            state.markNew(wid)
+
+
+def parseSearchPageData(htmldata):
+    """Reads the item-data steam embeds as json in the search page.
+    Returns a dict of wid -> data with title and description"""
+    decoder = json.JSONDecoder()
+    pageData = {}
+    for match in hoverDataPattern.finditer(htmldata):
+        try:
+            data, _ = decoder.raw_decode(htmldata, match.end())
+        except ValueError:
+            continue
+        pageData[match.group(1)] = data
+    return pageData
+
+
+def isReported(wid, updated, details):
+    if updated:
+        lastUpdated = getUpdateTime(details, wid)
+        return lastUpdated is not None and state.isUpdateReported(wid, lastUpdated)
+    return state.isNewReported(wid)
+
+
+def crawlSearchPages(url, updated):
+    """Reads the search pages until one contains an already reported item, the
+    last page (one with fewer than 30 items) or max_search_pages. Returns the items in search order, the item-data
+    from the page-scripts and the api details"""
+    workshopItems = []
+    pageData = {}
+    details = {}
+    seen = set()
+    if updated and subscriptions is not None:
+        checked = subscriptions.refresh()
+        if checked > 0:
+            print(f"Checked {checked} workshop folders for subscriptions")
+    for page in range(1, maxSearchPages + 1):
+        pageUrl = url if page == 1 else f"{url}&p={page}"
+        htmldata = fetchPage(pageUrl)
+        soup = html_parsing.parse(htmldata, html_parsing.SEARCH_PAGE)
+        pageItems = soup.findAll("div", {"class": "workshopItem"})
+        pageData.update(parseSearchPageData(htmldata))
+        print(f"Page {page}: {len(pageItems)} workshop items")
+        wids = []
+        for each_div in pageItems:
+            wid = getItemLink(each_div).split('=')[1]
+            # Items move down while paging, so the same one can show up twice
+            if wid in seen:
+                continue
+            seen.add(wid)
+            # Unsubscribed updates are dropped before anything is fetched for them
+            if updated and subscriptions is not None and not subscriptions.isSubscribed(wid):
+                print(wid + " is not subscribed, ignoring")
+                continue
+            wids.append(wid)
+            workshopItems.append(each_div)
+        pageDetails = {}
+        if (updated or useApi) and wids:
+            pageDetails = fetchDetails(wids)
+            details.update(pageDetails)
+        if test or len(pageItems) < searchPageSize:
+            break
+        if any(isReported(wid, updated, details) for wid in wids):
             break
-        print(f"Parsing new item {i}")
-        generateDiscordPost(workshopItems[i], scripts[i], newDiscord, False)
-    postDiscordMessages(newDiscord, False)
-
-if (updatedModsUrl):
-    page = urlopen(updatedModsUrl)
-    htmldata = page.read().decode("utf-8")
-    soup = BeautifulSoup(htmldata, "html.parser")
-    pattern = re.compile('description":"[^"]+"', re.MULTILINE)
-    workshopItems = soup.findAll("div", {"class": "workshopItem"})
-    scripts = soup.findAll("script", text=pattern)
-    print(f"{len(workshopItems)} workshop items, {len(scripts)} scripts")
-    for i in range(len(workshopItems) - 1):
-        if (test and i >= 10):
-            print(f"Only testing, will only print {i}")
+        # Without the api-times a reported update can not be seen cheaply, so do not go deeper
+        if updated and wids and not pageDetails:
             break
-        print(f"Parsing updated item {i}")
-        generateDiscordPost(workshopItems[i], scripts[i], updatedDiscord, True)
-    postDiscordMessages(updatedDiscord, True)
+    return workshopItems, pageData, details
+
+
+def processSearchPage(url, webhookurl, updated):
+    with metrics.stage("search"):
+        workshopItems, pageData, details = crawlSearchPages(url, updated)
+    print(f"{len(workshopItems)} workshop items, {len(pageData)} scripts")
+    itemCount = len(workshopItems)
+    if (test and itemCount > 10):
+        print("Only testing, will only print 10")
+        itemCount = 10
+    kind = "updated" if updated else "new"
+    authors = {}
+    if useApi:
+        authors = fetchAuthors(details)
+    # Fetch all items in parallel, map() keeps the search order so the embeds
+    # are still saved in the order they appear on steam
+    with metrics.stage("items"), ThreadPoolExecutor(max_workers=fetchWorkers) as executor:
+        items = executor.map(lambda each_div: fetchItem(
+            each_div, updated, details, pageData, authors), workshopItems[:itemCount])
+        for i, item in enumerate(items):
+            print(f"Parsing {kind} item {i}")
+            metrics.count("items", kind=kind,
+                          result="processed" if item else "skipped")
+            if item:
+                generateDiscordPost(item, updated)
+    with metrics.stage("queue"):
+        postDiscordMessages(webhookurl, updated)
+
+
+def getUpdatedModsUrl():
+    if not updatedModsSearchUrl:
+        return None
+    return updatedModsSearchUrl + \
+        str(int((datetimesub.now() - timedelta(minutes=10)).timestamp()))
+
+
+def saveCaches():
+    authorCache.save()
+    if subscriptions is not None:
+        subscriptions.save()
+    fetcher.save()
+    print(fetcher.summary())
+
+
+def exportMetrics():
+    if not metrics.enabled:
+        return
+    fetcher.export_stats()
+    outbox.export_stats()
+    for channel in ("new", "updated"):
+        metrics.gauge("embeds_queued", state.queuedEmbeds(channel), channel=channel)
+    metrics.export()
+
+
+def runOnce():
+    with metrics.stage("digest"):
+        postOldDigest(updatedDiscord)
+
+    if (newModsUrl):
+        processSearchPage(newModsUrl, newDiscord, False)
+
+    updatedModsUrl = getUpdatedModsUrl()
+    if (updatedModsUrl):
+        processSearchPage(updatedModsUrl, updatedDiscord, True)
+
+    saveCaches()
+    exportMetrics()
+
+
+def runDigestJob():
+    with metrics.stage("digest"):
+        postOldDigest(updatedDiscord)
+    expired = state.expire(stateRetentionDays)
+    if expired > 0:
+        print(f"Expired {expired} old entries from the state database")
+
+
+def runDaemon():
+    """Runs the jobs on their own intervals until stopped, the state, caches and
+    connections are kept between the runs"""
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    now = time.time()
+    # The digest runs once an hour, just after the hour it collected changed
+    jobs = [{'name': "digest", 'next': now, 'run': runDigestJob,
+             'schedule': lambda: (time.time() // 3600 + 1) * 3600 + 60}]
+    if newModsUrl:
+        jobs.append({'name': "new", 'next': now, 'run': lambda: processSearchPage(newModsUrl, newDiscord, False),
+                     'schedule': lambda: time.time() + daemonNewMinutes * 60})
+    if updatedModsSearchUrl:
+        jobs.append({'name': "updated", 'next': now, 'run': lambda: processSearchPage(getUpdatedModsUrl(), updatedDiscord, True),
+                     'schedule': lambda: time.time() + daemonUpdatedMinutes * 60})
+    print(f"Running as daemon, jobs: {', '.join(job['name'] for job in jobs)}")
+    try:
+        while not stopping.is_set():
+            job = min(jobs, key=lambda job: job['next'])
+            wait = job['next'] - time.time()
+            if wait > 0:
+                stopping.wait(wait)
+                continue
+            try:
+                job['run']()
+                saveCaches()
+            except Exception:
+                print(f"The {job['name']} job failed, retrying on the next run")
+                traceback.print_exc()
+                metrics.count("job_failures", job=job['name'])
+            exportMetrics()
+            job['next'] = job['schedule']()
+    except KeyboardInterrupt:
+        pass
+    print("Stopping daemon")
+
+
+if daemon:
+    runDaemon()
+else:
+    runOnce()
+
+outbox.flush(discordFlushSeconds)
+outbox.stop()
+state.close()
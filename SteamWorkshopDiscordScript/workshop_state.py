@@ -0,0 +1,239 @@
+"""Indexed store for the workshop scraper state
+
+Replaces the empty marker files in {caching_folder}/new and
+{caching_folder}/updated, the embed spool-files in {caching_folder}/embeds
+and the hourly post-counters with one SQLite database
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# Updated-markers were named <wid><timestamp>, where the timestamp is str(float)
+UPDATED_MARKER = re.compile(r'^(\d+?)(\d{10}\.\d+)$')
+# Post-counters were named new<hour> and update<hour> next to the spool-folders
+POST_COUNTER = re.compile(r'^(new|update)(\d{1,2})$')
+HOUR_FORMAT = '%Y%m%d%H'
+
+
+class WorkshopState(object):
+    connection = None
+    lock = None
+
+    def __init__(self, databasePath):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            str(databasePath), check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS new (wid TEXT PRIMARY KEY, reported REAL NOT NULL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS updated (wid TEXT NOT NULL, updated TEXT NOT NULL, reported REAL NOT NULL, PRIMARY KEY (wid, updated))')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS new_reported ON new (reported)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS updated_reported ON updated (reported)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            # Embeds waiting to be posted, seq gives the order within a channel
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS embeds (seq INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, data TEXT NOT NULL, queued REAL NOT NULL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS embeds_channel ON embeds (channel, seq)')
+            columns = [column[1] for column in self.connection.execute(
+                'PRAGMA table_info(embeds)')]
+            if 'wid' not in columns:
+                self.connection.execute('ALTER TABLE embeds ADD COLUMN wid TEXT')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS embeds_wid ON embeds (channel, wid)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS posts (channel TEXT NOT NULL, hour TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (channel, hour))')
+
+    def isNewReported(self, wid):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM new WHERE wid = ?', (wid,)).fetchone()
+        return row is not None
+
+    def isUpdateReported(self, wid, lastUpdated):
+        """True if this update was reported, or anything of the mod was reported after it.
+        The api and the changelog give different keys for the same update (exact utc seconds
+        against minutes in local time), so the time of the report is compared as well"""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM updated WHERE wid = ? AND (updated = ? OR reported >= ?) LIMIT 1',
+                (wid, lastUpdated, float(lastUpdated))).fetchone()
+        return row is not None
+
+    def markNew(self, wid, reported=None):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO new (wid, reported) VALUES (?, ?)',
+                                    (wid, reported or time.time()))
+
+    def markUpdated(self, wid, lastUpdated, reported=None):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO updated (wid, updated, reported) VALUES (?, ?, ?)',
+                                    (wid, lastUpdated, reported or time.time()))
+
+    def queueEmbed(self, channel, data, wid=None, merge=None):
+        """Queues the embed data, if wid is given an embed still queued for the same mod
+        is replaced in its place in the queue. merge(oldData, newData) can combine the two"""
+        with self.lock, self.connection:
+            queued = []
+            if wid is not None:
+                queued = self.connection.execute('SELECT seq, data FROM embeds WHERE channel = ? AND wid = ? ORDER BY seq',
+                                                 (channel, wid)).fetchall()
+            if not queued:
+                return self.connection.execute('INSERT INTO embeds (channel, wid, data, queued) VALUES (?, ?, ?, ?)',
+                                               (channel, wid, data, time.time())).lastrowid
+            if merge is not None:
+                for _, oldData in reversed(queued):
+                    data = merge(oldData, data)
+            seq = queued[0][0]
+            self.connection.execute(
+                'UPDATE embeds SET data = ? WHERE seq = ?', (data, seq))
+            self.connection.executemany(
+                'DELETE FROM embeds WHERE seq = ?', [(row[0],) for row in queued[1:]])
+            return seq
+
+    def peekEmbeds(self, channel, limit):
+        """Returns the oldest (seq, data) of the channel, they stay queued until acknowledged"""
+        with self.lock:
+            return self.connection.execute('SELECT seq, data FROM embeds WHERE channel = ? ORDER BY seq LIMIT ?',
+                                           (channel, limit)).fetchall()
+
+    def queuedEmbeds(self, channel):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM embeds WHERE channel = ?', (channel,)).fetchone()[0]
+
+    def ackEmbeds(self, channel, seqs, hour):
+        """Removes posted embeds and counts the post for the hour in one transaction"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'DELETE FROM embeds WHERE seq = ?', [(seq,) for seq in seqs])
+            self.connection.execute('INSERT INTO posts (channel, hour, count) VALUES (?, ?, 1) '
+                                    'ON CONFLICT (channel, hour) DO UPDATE SET count = count + 1', (channel, hour))
+
+    def postsInHour(self, channel, hour):
+        """Returns the posts made in the hour, counters of other hours are dropped"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM posts WHERE channel = ? AND hour != ?', (channel, hour))
+            row = self.connection.execute(
+                'SELECT count FROM posts WHERE channel = ? AND hour = ?', (channel, hour)).fetchone()
+        return row[0] if row else 0
+
+    def expire(self, retentionDays, vacuumHours=24):
+        """Removes entries reported more than retentionDays ago, returns the number removed.
+        The freed space is only reclaimed once per vacuumHours, VACUUM rewrites the whole database"""
+        if not retentionDays or retentionDays <= 0:
+            return 0
+        now = time.time()
+        cutoff = now - retentionDays * 86400
+        with self.lock:
+            with self.connection:
+                removed = self.connection.execute(
+                    'DELETE FROM new WHERE reported < ?', (cutoff,)).rowcount
+                removed += self.connection.execute(
+                    'DELETE FROM updated WHERE reported < ?', (cutoff,)).rowcount
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'vacuumed'").fetchone()
+            if removed > 0 and (not row or now - float(row[0]) >= vacuumHours * 3600):
+                with self.connection:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO meta (key, value) VALUES ('vacuumed', ?)", (str(now),))
+                self.connection.execute('VACUUM')
+        return removed
+
+    def migrateMarkers(self, newPath, updatedPath):
+        """One-time import of the old marker files, the files are removed once imported"""
+        with self.lock:
+            done = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'markers_migrated'").fetchone()
+        if done:
+            return 0
+        migrated = 0
+        for folder, isUpdated in ((newPath, False), (updatedPath, True)):
+            if not os.path.isdir(folder):
+                continue
+            rows = []
+            for entry in os.scandir(folder):
+                if not entry.is_file():
+                    continue
+                reported = entry.stat().st_mtime
+                if isUpdated:
+                    match = UPDATED_MARKER.match(entry.name)
+                    if not match:
+                        continue
+                    rows.append((match.group(1), match.group(2), reported))
+                else:
+                    rows.append((entry.name, reported))
+            with self.lock, self.connection:
+                if isUpdated:
+                    self.connection.executemany(
+                        'INSERT OR IGNORE INTO updated (wid, updated, reported) VALUES (?, ?, ?)', rows)
+                else:
+                    self.connection.executemany(
+                        'INSERT OR IGNORE INTO new (wid, reported) VALUES (?, ?)', rows)
+            for row in rows:
+                os.remove(Path(f'{folder}/' + ''.join(row[:-1])))
+            migrated += len(rows)
+            if not os.listdir(folder):
+                os.rmdir(folder)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('markers_migrated', ?)", (str(time.time()),))
+        return migrated
+
+    def migrateEmbeds(self, embedsPath, hour):
+        """One-time import of the old embed spool-files and the counters of the hour, the files are removed once imported"""
+        with self.lock:
+            done = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'embeds_migrated'").fetchone()
+        if done:
+            return 0
+        migrated = 0
+        if os.path.isdir(embedsPath):
+            for channel in ('new', 'updated'):
+                folder = Path(f'{embedsPath}/{channel}')
+                if not os.path.isdir(folder):
+                    continue
+                files = [entry for entry in os.scandir(folder) if entry.is_file()]
+                files.sort(key=lambda entry: entry.stat().st_mtime)
+                for entry in files:
+                    with open(entry.path, 'r', encoding="utf-8") as the_file:
+                        data = the_file.read()
+                    if data:
+                        with self.lock, self.connection:
+                            self.connection.execute('INSERT INTO embeds (channel, data, queued) VALUES (?, ?, ?)',
+                                                    (channel, data, entry.stat().st_mtime))
+                        migrated += 1
+                    os.remove(entry.path)
+                if not os.listdir(folder):
+                    os.rmdir(folder)
+            for entry in os.scandir(embedsPath):
+                match = POST_COUNTER.match(entry.name)
+                if not entry.is_file() or not match:
+                    continue
+                # Only the counter written in the current hour still matters
+                if time.strftime(HOUR_FORMAT, time.localtime(entry.stat().st_mtime)) == hour:
+                    with open(entry.path, 'r', encoding="utf-8") as the_file:
+                        count = the_file.read().strip()
+                    if count.isdigit():
+                        channel = 'new' if match.group(1) == 'new' else 'updated'
+                        with self.lock, self.connection:
+                            self.connection.execute('INSERT OR REPLACE INTO posts (channel, hour, count) VALUES (?, ?, ?)',
+                                                    (channel, hour, int(count)))
+                os.remove(entry.path)
+            if not os.listdir(embedsPath):
+                os.rmdir(embedsPath)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('embeds_migrated', ?)", (str(time.time()),))
+        return migrated
+
+    def close(self):
+        self.connection.close()